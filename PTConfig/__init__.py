@@ -14,3 +14,84 @@ class Config:
     Bans: list[str]
     BadWords: list[str]
 
+    # "threaded" runs a thread per connection, "asyncio" runs every client on one event loop
+    Engine: str = "threaded"
+
+    # Track which room every client is in instead of scanning all clients each tick
+    RoomIndex: bool = True
+    # Only send players within this distance of each other, 0 sends the whole room
+    CullRadius: float = 0
+
+    # Let clients that ask for it receive only what changed since their last ack
+    DeltaUpdates: bool = True
+    # Send a full state every this many delta updates
+    DeltaKeyframe: int = 120
+
+    # Let clients that ask for it switch to the binary protocol after logging in
+    BinaryProtocol: bool = True
+
+    # Largest packet a client may send, in bytes
+    MaxFrameSize: int = 4096
+
+    # Push updates to every client this many times a second, 0 replies to each packet instead
+    TickRate: int = 0
+
+    # Messages a client may have waiting before it is kicked, and how many are sent at once to binary clients and ones that ask for it
+    MaxQueue: int = 64
+    QueueBatch: int = 8
+    # Bytes that may wait to be sent to a client, and seconds it may stay behind on sends, before it's kicked
+    SendBuffer: int = 256 * 1024
+    SendTimeout: float = 5
+
+    # Client IDs have this many digits, and a released ID isn't reused for this many seconds
+    IdDigits: int = 4
+    IdReuseDelay: float = 60
+
+    # Also catch bad words in a different case, or with numbers and symbols standing in for letters
+    FilterIgnoreCase: bool = False
+    FilterLeetspeak: bool = False
+
+    # Allowed sprite prefixes and exact names, None uses the built-in lists
+    AnticheatPrefixes: list[str] | None = None
+    AnticheatSprites: list[str] | None = None
+    AnticheatCacheSize: int = 256
+    # Furthest a player may move in one update and room changes allowed per second, 0 disables the check
+    AnticheatMaxJump: float = 0
+    AnticheatRoomChanges: int = 0
+    # Kick a player after this many anticheat flags, 0 never kicks
+    AnticheatKick: int = 0
+
+    # Seconds a connection may take to log in, and a paused player may stay silent, 0 uses Timeout
+    LoginTimeout: int = 0
+    PausedTimeout: int = 0
+
+    # Pending connections the OS queues before they're accepted
+    Backlog: int = 128
+    # New connections allowed per second from one IP on average and in a burst, 0 disables the limit
+    ConnectRate: float = 0
+    ConnectBurst: int = 5
+
+    # Packets per second and burst allowed from one client for state updates, chat lines and commands, 0 disables the limit
+    StateRate: float = 0
+    StateBurst: int = 120
+    ChatRate: float = 0
+    ChatBurst: int = 5
+    CommandRate: float = 0
+    CommandBurst: int = 5
+    # Refused chat lines and commands a client may pile up before it's kicked, 0 never kicks
+    RateKick: int = 0
+
+    # Worker processes lobbies are spread over, each with its own share of client IDs, 0 or 1 runs everything in one process
+    # Shards always use the threaded engine and need a platform that can fork
+    Shards: int = 0
+
+    # Collect metrics (shown by /stats), timing one in MetricsSample loop iterations of each client
+    Metrics: bool = True
+    MetricsSample: int = 16
+    # Port of the local Prometheus endpoint, 0 disables it
+    MetricsPort: int = 0
+
+    # Where profiles started with /profile and the slow loop log are written
+    ProfileDirectory: str = "profiles"
+    # Seconds a client loop iteration may be busy before its stack is logged, 0 disables it
+    SlowLoop: float = 0
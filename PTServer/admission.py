@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import PTUtils
+
+from . import client
+
+class AdmissionController:
+    """ Decides whether a new connection may join, before any client state or thread is created for it. """
+    def __init__(self, max_players: int, max_connections: int, rate: float = 0, burst: float = 5):
+        self.MaxPlayers: int = max_players
+        self.MaxConnections: int = max_connections
+        self.Rate: float = rate
+        self.Burst: float = burst
+
+        self.Total: int = 0
+        self.Counts: dict[str, int] = {}
+        self.Buckets: dict[str, PTUtils.TokenBucket] = {}
+        self.LastPrune: float = 0
+        self.Mutex: threading.Lock = threading.Lock()
+
+    def admit(self, ip256: str) -> str | None:
+        """ Reserves a slot for a connection from the given IP hash, returns the reason if it's refused. """
+        with self.Mutex:
+            if self.Rate > 0 and not self._bucket(ip256).take():
+                return "You are connecting too fast."
+
+            if self.Total >= self.MaxPlayers:
+                return "The server is full."
+
+            count = self.Counts.get(ip256, 0)
+            if count >= self.MaxConnections:
+                return "You are already connected with the max amount of connections."
+
+            self.Counts[ip256] = count + 1
+            self.Total += 1
+
+        return None
+
+    def release(self, c: client.Client):
+        """ Frees the slot of an admitted client, only the first call for a client does anything. """
+        with self.Mutex:
+            if not c.Admitted:
+                return
+
+            c.Admitted = False
+            self._free(c.Ip256)
+
+    def cancel(self, ip256: str):
+        """ Frees a slot reserved by admit without a client, e.g. when none could be created or it lives in a shard. """
+        with self.Mutex:
+            self._free(ip256)
+
+    def _free(self, ip256: str):
+        self.Total -= 1
+
+        count = self.Counts[ip256] - 1
+        if count > 0:
+            self.Counts[ip256] = count
+        else:
+            del self.Counts[ip256]
+
+    def _bucket(self, ip256: str) -> PTUtils.TokenBucket:
+        now = time.monotonic()
+
+        # Buckets that have filled back up are the same as new ones, so drop them now and then
+        if now - self.LastPrune > 60:
+            self.Buckets = {ip: bucket for ip, bucket in self.Buckets.items() if not bucket.full(now)}
+            self.LastPrune = now
+
+        bucket = self.Buckets.get(ip256, None)
+        if bucket is None:
+            bucket = PTUtils.TokenBucket(self.Rate, self.Burst)
+            self.Buckets[ip256] = bucket
+
+        return bucket
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import asyncio
+
+import PTUtils
+
+from . import client
+from . import server
+
+class StreamConnection:
+    """ Socket-like wrapper around an asyncio stream, so clients can send without knowing the engine. """
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.Writer: asyncio.StreamWriter = writer
+
+    def send(self, data: bytes):
+        if self.Writer.is_closing():
+            raise ConnectionResetError("Connection closed")
+
+        self.Writer.write(data)
+
+    # The transport writes whatever it buffered whenever the socket takes it, there's nothing to do here
+    def flush(self) -> int:
+        return self.pending()
+
+    def pending(self) -> int:
+        return self.Writer.transport.get_write_buffer_size()
+
+    def sendall(self, data: bytes):
+        self.send(data)
+
+    def close(self):
+        self.Writer.close()
+
+async def check_connections(srv: server.Server):
+    while srv.Up:
+        srv.expire_clients()
+        await asyncio.sleep(1)
+
+async def serve(srv: server.Server):
+    """ Runs accept, read, parse and send for every client on the current event loop. """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        ip256 = PTUtils.sha256(addr[0])
+
+        reason = srv.Admission.admit(ip256)
+        if reason is not None:
+            srv.refuse(StreamConnection(writer), reason)
+            return
+
+        try:
+            id = srv.Ids.allocate()
+        except RuntimeError as e:
+            srv.Admission.cancel(ip256)
+            srv.refuse(StreamConnection(writer), "The server is full.")
+            print(f"Failed to accept connection: {e}")
+            return
+
+        c = client.Client(
+            id = id,
+            conn = StreamConnection(writer),
+            ip256 = ip256,
+            server = srv
+        )
+        c.Admitted = True
+        c.admit()
+
+        await c.loop_async(reader)
+
+    try:
+        listener = await asyncio.start_server(handle, srv.Host, srv.Port, backlog=srv.Backlog)
+    except Exception as e:
+        print(f"Failed to bind to {srv.Host}:{srv.Port}: {e}")
+        srv.Up = False
+        return
+
+    print(f"Server started on {srv.Host}:{srv.Port} (asyncio)")
+
+    if srv.Scheduler is not None:
+        asyncio.create_task(srv.Scheduler.run_async())
+
+    async with listener:
+        await check_connections(srv)
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import functools
+import time
+
+import PTUtils
+
+from . import client
+
+class Anticheat:
+    """ Validates sprites against configurable tables and catches impossible movement. """
+    def __init__(
+        self,
+        prefixes: list[str] | None = None,
+        names: list[str] | None = None,
+        fallback: str = PTUtils.DEFAULT_SPRITE,
+        cache_size: int = 256,
+        max_jump: float = 0,
+        room_changes: int = 0,
+        kick_after: int = 0
+    ):
+        self.Prefixes: tuple[str] = tuple(prefixes) if prefixes is not None else PTUtils.SPRITE_PREFIXES
+        self.Names: frozenset[str] = frozenset(names) if names is not None else PTUtils.SPRITE_NAMES
+        self.Fallback: str = fallback
+
+        self.MaxJump: float = max_jump
+        self.RoomChanges: int = room_changes
+        self.KickAfter: int = kick_after
+
+        # Only a handful of sprites are ever in use, so most packets are a cache hit
+        self.sprite = functools.lru_cache(maxsize=cache_size)(self._sprite)
+
+    def _sprite(self, sprite: str) -> str:
+        if sprite.startswith(self.Prefixes) or sprite in self.Names:
+            return sprite
+
+        return self.Fallback
+
+    def check_sprite(self, sprite: str) -> str:
+        """ Returns the sprite if it's allowed, the fallback sprite otherwise. """
+        if not isinstance(sprite, str):
+            return self.Fallback
+
+        return self.sprite(sprite)
+
+    def check_movement(self, c: client.Client, x, y, room):
+        """
+        Compares a new state against the client's current one and flags impossible movement.
+        The new state is still accepted, since one teleport can be legitimate (a respawn or a portal) and
+        rejecting it would leave every later packet compared against a stale position. Repeated flags add up to a kick.
+        """
+        if room != c.Data.Room:
+            if self.RoomChanges > 0:
+                now = time.monotonic()
+
+                if now - c.RoomWindow >= 1:
+                    c.RoomWindow = now
+                    c.RoomHops = 0
+
+                # Flagged once per window, not again for every hop after the limit
+                c.RoomHops += 1
+                if c.RoomHops == self.RoomChanges + 1:
+                    self.flag(c, "changing rooms too fast")
+
+            return
+
+        if self.MaxJump <= 0:
+            return
+
+        try:
+            dx, dy = x - c.Data.X, y - c.Data.Y
+        except TypeError:
+            return
+
+        if dx * dx + dy * dy > self.MaxJump * self.MaxJump:
+            self.flag(c, "moving too fast")
+
+    def flag(self, c: client.Client, reason: str):
+        c.CheatFlags += 1
+
+        if self.KickAfter > 0 and c.CheatFlags >= self.KickAfter and c.Active:
+            print(f"Client {c.ID} kicked by anticheat: {reason}")
+            c.ConnectedServer.kick(c.ID, "Kicked by anticheat.")
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import collections
+import json
+import threading
+
+from .messages import Message
+
+class MessageIds:
+    """ Monotonically increasing message IDs shared by every chat on the server. """
+    def __init__(self):
+        self.Last: int = 0
+        self.Mutex: threading.Lock = threading.Lock()
+
+    def next(self) -> int:
+        with self.Mutex:
+            self.Last += 1
+            return self.Last
+
+class ChatEntry:
+    """ A chat message with its JSON encoded once, shared by everyone who can see it. """
+    __slots__ = ("Mid", "Msg", "Json", "Text")
+
+    def __init__(self, mid: int, msg: Message):
+        msg.Mid = mid
+
+        self.Mid: int = mid
+        self.Msg: Message = msg
+        self.Json: dict = msg.to_json()
+        self.Text: str = json.dumps(self.Json)
+
+class ChatLog:
+    """ The recent chat of one lobby, stored once as a ring buffer. """
+    def __init__(self, ids: MessageIds, size: int = 32):
+        self.Ids: MessageIds = ids
+        self.Entries: collections.deque[ChatEntry] = collections.deque(maxlen=size)
+        self.Mutex: threading.Lock = threading.Lock()
+
+    def add(self, msg: Message) -> ChatEntry:
+        # IDs are taken under the lock so the ring buffer stays in order
+        with self.Mutex:
+            entry = ChatEntry(self.Ids.next(), msg)
+            self.Entries.append(entry)
+
+        return entry
+
+    def since(self, mid: int) -> list[ChatEntry]:
+        """ Returns the entries newer than the given message ID. """
+        with self.Mutex:
+            return [entry for entry in self.Entries if entry.Mid > mid]
+
+class ClientChat:
+    """ What one client sees of the chat: its lobby's log from a cursor on, plus its private messages. """
+    def __init__(self, ids: MessageIds, mutex: threading.Lock, size: int = 32):
+        self.Ids: MessageIds = ids
+        self.Mutex: threading.Lock = mutex
+        self.Size: int = size
+
+        self.Log: ChatLog | None = None
+        self.Cursor: int = 0
+        self.Private: collections.deque[ChatEntry] = collections.deque(maxlen=size)
+
+    def join(self, log: ChatLog | None):
+        """ Follows a lobby's log, only showing what is said from now on. """
+        with self.Mutex:
+            self.Log = log
+            self.Cursor = self.Ids.Last
+
+    def add(self, msg: Message) -> ChatEntry:
+        """ Adds a message only this client can see. """
+        entry = ChatEntry(self.Ids.next(), msg)
+
+        with self.Mutex:
+            self.Private.append(entry)
+
+        return entry
+
+    def clear(self):
+        """ Hides everything received so far, for this client only. """
+        with self.Mutex:
+            self.Cursor = self.Ids.Last
+            self.Private.clear()
+
+    def entries(self) -> list[ChatEntry]:
+        """ Returns the newest messages visible to the client, oldest first. """
+        with self.Mutex:
+            log = self.Log
+            cursor = self.Cursor
+            private = list(self.Private)
+
+        public = log.since(cursor) if log is not None else []
+
+        if len(private) == 0:
+            return public[-self.Size:]
+
+        return sorted(public + private, key=lambda entry: entry.Mid)[-self.Size:]
+
+    def json(self) -> list[dict]:
+        return [entry.Json for entry in self.entries()]
+
+    def text(self) -> str:
+        """ Returns the visible messages as an already encoded JSON array. """
+        return "[" + ", ".join(entry.Text for entry in self.entries()) + "]"
+
+    def __iter__(self):
+        return iter([entry.Msg for entry in self.entries()])
+
+    def __len__(self):
+        return len(self.entries())
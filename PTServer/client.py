@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import asyncio
+import collections
 import json
-import random
-import socket
+import math
 import time
 import threading
 
@@ -11,64 +12,103 @@ from dataclasses import dataclass
 import PTUtils
 import PTCommand
 
+from . import aio
+from . import connection
+from . import profiling
 from . import server
-from .messages import CompactClient, CompactMessage, MessageType, Message
+from .chat import ClientChat
+from .codec import BinaryCodec
+from .delta import DeltaTracker
+from .stream import JsonStream
+from .messages import CompactMessage, MessageType, Message, encode_response
 
 class Client:
     def __init__(self, id: int, conn: tuple, ip256: str, server: server.Server):
         self.ID: int = id
-        self.Conn: socket.socket = conn
+        self.Conn: connection.SocketConnection | aio.StreamConnection = conn
         self.Ip256: str = ip256
         self.Name: str = ""
         self.Admin: bool = False
         self.Active: bool = False
+        # Holds one of the server's admission slots until closed
+        self.Admitted: bool = False
         self.Paused: bool = False
         self.LoggedIn: bool = False
         self.Lobby: str = ""
 
         self.ConnectedServer: server.Server = server
+        self.SendMutex: threading.Lock = threading.Lock()
+        # Monotonic time sends started piling up in the connection, 0 while they keep up
+        self.BehindSince: float = 0
         self.Data: ClientData = ClientData()
+        # Monotonic time of the last received data, checked by the server's IdleTimers
         self.LastMessage: float = 0
 
-        self.Queue: list[CompactMessage] = []
-        self.QueueMutex: threading.Lock = threading.Lock()
+        # Everything other clients see of this one, serialized again only after it changes
+        self.Dirty: bool = True
+        self.Entry: tuple[int, float, float, str, dict] | None = None
+
+        self.Queue: collections.deque[CompactMessage] = collections.deque()
+        self.QueueMutex: threading.Lock = server.Metrics.lock("QueueMutex")
+        self.QueueOverflow: bool = False
+        # Queued messages sent at once, more than one only for clients that can split them up again
+        self.Batch: int = 1
         self.MsgTries: int = 0
 
         self.ParseFails: int = 0
+        self.StateLimit: PTUtils.TokenBucket | None = limiter(server.StateRate, server.StateBurst)
+        self.ChatLimit: PTUtils.TokenBucket | None = limiter(server.ChatRate, server.ChatBurst)
+        self.CommandLimit: PTUtils.TokenBucket | None = limiter(server.CommandRate, server.CommandBurst)
+        # One strike per refused chat line or command, one is forgiven every 10 seconds
+        self.Strikes: PTUtils.TokenBucket | None = PTUtils.TokenBucket(1 / 10, server.RateKick) if server.RateKick > 0 else None
+        self.CheatFlags: int = 0
+        self.RoomHops: int = 0
+        self.RoomWindow: float = 0
+        self.Stream: JsonStream = JsonStream(server.MaxFrameSize)
         self.Color: str = ""
-        self.Chat: list[Message] = []
-        self.ChatMutex: threading.Lock = threading.Lock()
+        self.ChatMutex: threading.Lock = server.Metrics.lock("ChatMutex")
+        self.Chat: ClientChat = ClientChat(server.ChatIds, self.ChatMutex)
+
+        # Only set once the client asks for delta updates or the binary protocol when logging in
+        self.Tracker: DeltaTracker | None = None
+        self.Codec: BinaryCodec | None = None
+
+        # Traffic counters, and whether the current loop iteration is one the server's Metrics time
+        self.BytesIn: int = 0
+        self.BytesOut: int = 0
+        self.PacketsIn: int = 0
+        self.PacketsOut: int = 0
+        self.Iterations: int = 0
+        self.Timing: bool = False
+
+        # Set while an admin profiles this client, and when the busy part of the current loop iteration started for the slow loop watchdog
+        self.Profile: profiling.ClientProfile | None = None
+        self.Busy: float = 0
+        self.Thread: int = 0
 
     def accept(self):
-        print(f"New connection from: {self.Ip256}")
-
-        previousConnections = 0
-
-        with self.ConnectedServer.ClientMutex:
-            for _, client in self.ConnectedServer.Clients.items():
-                if client.Ip256 == self.Ip256:
-                    previousConnections += 1
+        self.admit()
+        self.loop()
 
-                if previousConnections >= self.ConnectedServer.MaxConnections:
-                    self.ConnectedServer.ClientMutex.release()
-                    self.close(MessageType.OmsgKick, "You are already connected with the max amount of connections.")
-                    return
+    def admit(self):
+        """ Registers the client with the server, connection limits are checked before it's created. """
+        print(f"New connection from: {self.Ip256}")
 
-        self.Chat = []
         self.Active = True
-        self.LastMessage = time.time()
-
-        with self.ConnectedServer.ClientMutex:
-            self.ConnectedServer.Clients[self.ID] = self
+        self.LastMessage = time.monotonic()
 
-        self.loop()
+        self.ConnectedServer.register(self)
 
     def loop(self):
         t = PTUtils.Ticker(1 / 60)
+        self.Thread = threading.get_ident()
 
         while t.tick():
             if not self.Active:
                 return
+
+            self.Timing = self.ConnectedServer.Metrics.sample(self)
+            start = time.perf_counter()
             
             try:
                 raw = self.Conn.recv(2048)
@@ -79,73 +119,197 @@ class Client:
                 self.close(MessageType.MsgNone, f"{e}")
                 return
 
-            self.parse(raw)
-            self.LastMessage = time.time()
+            if self.Timing:
+                self.ConnectedServer.Metrics.Phases["recv"].observe(time.perf_counter() - start)
 
-            if self.ParseFails > 10:
-                self.close(MessageType.OmsgKick, "Too many invalid packets.")
+            if self.ConnectedServer.SlowLoop > 0:
+                self.Busy = time.perf_counter()
+
+            if self.Profile is not None:
+                handled = self.Profile.receive(self, raw)
+            else:
+                handled = self.receive(raw)
+
+            self.Busy = 0
+
+            if not handled:
                 return
-            
-            response_data = {}
 
-            if len(self.Queue) > 0:
-                with self.QueueMutex:
-                    msg = self.Queue.pop(0)
+    async def loop_async(self, reader: asyncio.StreamReader):
+        """ Same as loop, but reads from an asyncio stream on the server's event loop. """
+        t = PTUtils.Ticker(1 / 60)
+        self.Thread = threading.get_ident()
 
-                response_data["type"] = msg.Type.value
-                response_data["msg"] = msg.Msg
-                response = json.dumps(response_data).encode()
+        while await t.tick_async():
+            if not self.Active:
+                return
 
-                try:
-                    self.Conn.sendall(response)
-                except Exception as e:
-                    self.close(MessageType.MsgNone, f"{e}")
+            self.Timing = self.ConnectedServer.Metrics.sample(self)
+            start = time.perf_counter()
+
+            try:
+                raw = await reader.read(2048)
+                if not raw:
+                    self.close(MessageType.MsgNone, "No data received.")
                     return
+            except Exception as e:
+                self.close(MessageType.MsgNone, f"{e}")
+                return
+
+            if self.Timing:
+                self.ConnectedServer.Metrics.Phases["recv"].observe(time.perf_counter() - start)
+
+            if self.ConnectedServer.SlowLoop > 0:
+                self.Busy = time.perf_counter()
+
+            if self.Profile is not None:
+                handled = self.Profile.receive(self, raw)
             else:
-                clients: list[CompactClient] = []
+                handled = self.receive(raw)
 
-                with self.ConnectedServer.ClientMutex:
-                    for _, client in self.ConnectedServer.Clients.items():
-                        if client.ID == self.ID or client.Lobby != self.Lobby or client.Data.Room != self.Data.Room:
-                            continue
+            self.Busy = 0
 
-                        clients.append(CompactClient(
-                            ID = client.ID,
-                            X = client.Data.X,
-                            Y = client.Data.Y,
-                            Name = client.Name,
-                            Admin = client.Admin,
-                            Room = client.Data.Room,
-                            Sprite = client.Data.Sprite,
-                            Frame = client.Data.Frame,
-                            Dir = client.Data.Dir,
-                            Palette = client.Data.Palette,
-                            PaletteSprite = client.Data.PaletteSprite,
-                            PaletteTexture = client.Data.PaletteTexture,
-                            Color = client.Data.Color
-                        ))
-
-                    response_data["clients"] = [client.to_json() for client in clients]
-
-                with self.ChatMutex:
-                    response_data["msgs"] = [msg.to_json() for msg in self.Chat]
-
-                response_data["type"] = MessageType.OmsgDefault.value
-                response_data["loggedIn"] = self.LoggedIn
-                response_data["admin"] = self.Admin
-                response_data["name"] = self.Name
-                response_data["id"] = self.ID
-                response_data["onlineCnt"] = self.ConnectedServer.lobby_count(self.Lobby)
-
-                response = json.dumps(response_data).encode()
-
-                try:
-                    self.Conn.sendall(response)
-                except Exception as e:
-                    self.close(MessageType.MsgNone, f"{e}")
-                    return
-                
+            if not handled:
+                return
+
+    def receive(self, raw: bytes) -> bool:
+        """ Handles a chunk of received data and responds, returns False if the client was closed. """
+        self.BytesIn += len(raw)
+
+        if self.Timing:
+            start = time.perf_counter()
+            self.parse(raw)
+            self.ConnectedServer.Metrics.Phases["parse"].observe(time.perf_counter() - start)
+        else:
+            self.parse(raw)
+
+        self.LastMessage = time.monotonic()
+
+        if self.ParseFails > 10:
+            self.close(MessageType.OmsgKick, "Too many invalid packets.")
+            return False
+
+        if not self.Active:
+            return False
+
+        # With a fixed tick rate the server pushes updates itself
+        if self.ConnectedServer.TickRate > 0:
+            return True
+
+        return self.respond()
+
+    def respond(self) -> bool:
+        """ Sends the next queued message, or the current state if nothing is queued. """
+        if self.QueueOverflow:
+            self.close(MessageType.OmsgKick, "Too many pending messages.")
+            return False
+
+        # Nothing new is sent until the client reads what it already has, the next update after that is current anyway
+        if self.behind():
+            return self.Active
 
+        timing = self.Timing
+        if timing:
+            self.ConnectedServer.Metrics.take_build()
+            start = time.perf_counter()
+
+        if len(self.Queue) > 0:
+            batch = []
+
+            with self.QueueMutex:
+                while len(self.Queue) > 0 and len(batch) < self.Batch:
+                    batch.append(self.Queue.popleft())
+
+            # Binary frames carry their own length, JSON messages are separated like incoming packets
+            separator = b"" if self.Codec is not None else b"\n"
+            response = separator.join(self.encode_message(msg.Type.value, msg.Msg) for msg in batch)
+        else:
+            response = self.encode_default()
+
+        if not timing:
+            return self.send(response)
+
+        metrics = self.ConnectedServer.Metrics
+        sent = time.perf_counter()
+        # Building the room snapshot is already counted under "build"
+        metrics.Phases["serialize"].observe(sent - start - metrics.take_build())
+
+        result = self.send(response)
+        metrics.Phases["send"].observe(time.perf_counter() - sent)
+
+        return result
+
+    def send(self, data: bytes) -> bool:
+        """ Sends data to the client without waiting for it to be read, closing it and returning False if that fails or too much is waiting. """
+        try:
+            with self.SendMutex:
+                self.Conn.send(data)
+                pending = self.Conn.pending()
+        except Exception as e:
+            self.close(MessageType.MsgNone, f"{e}")
+            return False
+
+        self.BytesOut += len(data)
+        self.PacketsOut += 1
+
+        if pending > self.ConnectedServer.SendBuffer:
+            self.close(MessageType.OmsgKick, "Connection too slow.")
+            return False
+
+        return True
+
+    def behind(self) -> bool:
+        """ Sends what's still waiting from earlier, returns True if some is left, kicking the client once it has been behind for SendTimeout. """
+        try:
+            with self.SendMutex:
+                pending = self.Conn.flush()
+        except Exception as e:
+            self.close(MessageType.MsgNone, f"{e}")
+            return True
+
+        if pending == 0:
+            self.BehindSince = 0
+            return False
+
+        now = time.monotonic()
+        if self.BehindSince == 0:
+            self.BehindSince = now
+        elif now - self.BehindSince > self.ConnectedServer.SendTimeout:
+            self.close(MessageType.OmsgKick, "Connection too slow.")
+
+        return True
+
+    def encode_default(self) -> bytes:
+        """ Builds the OmsgDefault response in whichever format the client chose on login. """
+        online = self.ConnectedServer.lobby_count(self.Lobby)
+
+        if self.Codec is not None:
+            clients = list(self.ConnectedServer.World.visible_states(self).values())
+            return self.Codec.encode_default(self.ID, self.LoggedIn, self.Admin, self.Name, online, clients, self.Chat.json())
+
+        raw = {}
+
+        if self.Tracker is not None:
+            response_data = self.Tracker.encode(self.ConnectedServer.World.visible_states(self), self.Chat.json())
+        else:
+            response_data = {}
+            raw["clients"] = self.ConnectedServer.World.visible(self)
+            raw["msgs"] = self.Chat.text()
+
+        response_data["type"] = MessageType.OmsgDefault.value
+        response_data["loggedIn"] = self.LoggedIn
+        response_data["admin"] = self.Admin
+        response_data["name"] = self.Name
+        response_data["id"] = self.ID
+        response_data["onlineCnt"] = online
+
+        return encode_response(response_data, **raw)
+
+    def encode_message(self, type: int, msg: str) -> bytes:
+        if self.Codec is not None:
+            return self.Codec.encode_message(type, msg)
+
+        return json.dumps(CompactMessage(Type = type, Msg = msg).to_json()).encode()
 
     def close(self, type: MessageType, msg: str):
         self.direct(
@@ -162,31 +326,20 @@ class Client:
         self.Conn.close()
         self.Active = False
 
-        if self.ConnectedServer.Clients.get(self.ID, None):
-            with self.ConnectedServer.ClientMutex:
-                del self.ConnectedServer.Clients[self.ID]
+        self.ConnectedServer.leave_lobby(self)
+        self.ConnectedServer.release_name(self)
+        self.ConnectedServer.unregister(self)
+        self.ConnectedServer.Ids.release(self.ID)
+        self.ConnectedServer.Admission.release(self)
 
     def parse(self, message):
-        data_objects = []
-
         try:
-            json_datas = message.decode().split("}\n{")
-            if len(json_datas) > 1:
-                json_datas[0] = json_datas[0] + "}"
-                json_datas[-1] = "{" + json_datas[-1]
-
-            for json_data in json_datas:
-                try:
-                    loded = json.loads(json_data)
-                except:
-                    continue
-
-                data_objects.append(ClientData.from_dict(loded))
-
+            data_objects = self.decode(message)
         except Exception as e:
 
             print(f"Client {self.ID} failed to parse message ({message}): {e}")
 
+            self.ConnectedServer.Metrics.ParseFailures += 1
             self.ParseFails += 1
             if self.ParseFails > 10:
                 self.close(MessageType.OmsgKick, "Too many parse fails.")
@@ -194,13 +347,30 @@ class Client:
             return
         
         self.ParseFails = 0
+        self.PacketsIn += len(data_objects)
+
+        # Only the newest state in a burst matters, so skip the older ones
+        latest = None
+        for data in data_objects:
+            if data.Type == MessageType.ImsgDefault.value:
+                latest = data
 
         for data in data_objects:
+            if data.Type == MessageType.ImsgDefault.value and data is not latest:
+                continue
+
+            # Dropping a state update is harmless, the next one replaces it anyway
+            if data is latest and self.LoggedIn and self.StateLimit is not None and not self.StateLimit.take():
+                continue
+
             if self.ConnectedServer.Anticheat:
-                data.Sprite = PTUtils.anticheat(data.Sprite)
+                data.Sprite = self.ConnectedServer.Cheats.check_sprite(data.Sprite)
 
             self.Paused = False
 
+            if self.Tracker is not None and data.Ack:
+                self.Tracker.ack(data.Ack)
+
             # print(f"Client {self.ID} sent data: ({data.Type}) {data.__dict__}")
             # print(loded)
 
@@ -220,36 +390,31 @@ class Client:
                         self.close(MessageType.OmsgKick, "Your client is outdated.")
                         return
                     
-                    data.Name = PTUtils.clean_name(data.Name, self.ConnectedServer.BadWords)
-
-                    # check if name is taken
-                    should_close = None
-
-                    with self.ConnectedServer.ClientMutex:
-                        if self.Admin:
-                            for id, client in self.ConnectedServer.Clients.items():
-                                if client.Name == data.Name and client.ID != self.ID:
-                                    should_close = client
-                        else:
-                            nm = data.Name
-
-                            while True:
-                                for _, client in self.ConnectedServer.Clients.items():
-                                    if client.Name == nm:
-                                        nm += str(random.randint(0, 9))
-                                        break
-                                else:
-                                    data.Name = nm
-                                    break
+                    data.Name = PTUtils.clean_name(data.Name, self.ConnectedServer.Filter)
+
+                    # check if name is taken, admins take the name over from whoever has it
+                    data.Name, should_close = self.ConnectedServer.claim_name(self, data.Name, self.Admin)
 
                     if should_close:
                         should_close.close(MessageType.MsgNone, "")
 
                     self.Data = data
                     self.Name = data.Name
-                    self.Lobby = data.Lobby
-                    self.LoggedIn = True
                     self.Color = data.Color
+                    self.Dirty = True
+                    self.ConnectedServer.join_lobby(self, data.Lobby)
+                    self.LoggedIn = True
+                    self.ConnectedServer.Timers.add(self)
+
+                    # Binary responses are already compact, so they never use delta updates
+                    if data.Binary is True and self.ConnectedServer.BinaryProtocol:
+                        self.Codec = BinaryCodec(self.ConnectedServer.MaxFrameSize)
+                    elif data.Delta is True and self.ConnectedServer.DeltaUpdates:
+                        self.Tracker = DeltaTracker(self.ConnectedServer.DeltaKeyframe)
+
+                    # Older game clients expect exactly one JSON object per send
+                    if self.Codec is not None or data.Batch is True:
+                        self.Batch = self.ConnectedServer.QueueBatch
 
                     print(f"Client {self.ID} logged in as {self.Name} ({self.Ip256})")
                     self.ConnectedServer.broadcast(f"{self.Name} has entered the tower!", self.Lobby)
@@ -258,8 +423,15 @@ class Client:
                 case MessageType.ImsgDefault.value:
                     if not self.LoggedIn:
                         return
+
+                    if self.ConnectedServer.Anticheat:
+                        self.ConnectedServer.Cheats.check_movement(self, data.X, data.Y, data.Room)
+
+                    if data.Room != self.Data.Room:
+                        self.ConnectedServer.move_room(self, data.Room)
                     
-                    self.Data = data
+                    self.Data.update(data)
+                    self.Dirty = True
                 
                 case MessageType.ImsgPaused.value:
                     if not self.LoggedIn:
@@ -275,22 +447,50 @@ class Client:
                         return
                     
                     if data.Msg.startswith("/"):
-                        self.command(data.Msg)
+                        if self.allow(self.CommandLimit, "commands"):
+                            self.command(data.Msg)
+                        return
+
+                    if not self.allow(self.ChatLimit, "messages"):
                         return
                     
-                    data.Msg = PTUtils.clean(data.Msg, 256, self.ConnectedServer.BadWords)
+                    data.Msg = PTUtils.clean(data.Msg, 256, self.ConnectedServer.Filter)
                     
-                    with self.ConnectedServer.ClientMutex:
-                        for id, client in self.ConnectedServer.Clients.items():
-                            if client.Lobby == self.Lobby and client.Active and client.LoggedIn:
-                                client.pm(Message(
-                                    Body = data.Msg,
-                                    Username = self.Name,
-                                    Id = self.ID
-                                ))
-                            # else:
-                            #     print(f"Client {self.ID} tried to send a message to {client.ID} but they are not in the same lobby.")
+                    # Stored once in the lobby's log, every member reads it from there
+                    self.ConnectedServer.lobby_chat(self.Lobby).add(Message(
+                        Body = data.Msg,
+                        Username = self.Name,
+                        Id = self.ID
+                    ))
+
+        # The login switched to the binary protocol, whatever followed it in the same data is binary frames
+        if self.Codec is not None and self.Stream.Buffer:
+            rest, self.Stream.Buffer = self.Stream.Buffer, b""
+            self.parse(rest)
+
+    def allow(self, bucket: PTUtils.TokenBucket | None, what: str) -> bool:
+        """ Takes a token for a chat line or command, refusals count as strikes towards a kick. """
+        if bucket is None or bucket.take():
+            return True
+
+        if self.Strikes is not None and not self.Strikes.take():
+            self.ConnectedServer.kick(self.ID, f"Sending {what} too fast.")
+            return False
+
+        self.server_pm(f"You are sending {what} too fast.")
+        return False
+
+    def decode(self, message: bytes) -> list[ClientData]:
+        """ Splits received data into packets, using the binary codec if the client chose it on login. """
+        if self.Codec is not None:
+            return [ClientData.from_dict(self.Codec.decode(frame)) for frame in self.Codec.feed(message)]
 
+        # Until logged in, a login asking for the binary protocol ends the JSON part of the stream
+        packets = self.Stream.feed(message, None if self.LoggedIn else self.switches_protocol)
+        return [ClientData.from_dict(packet) for packet in packets]
+
+    def switches_protocol(self, packet: dict) -> bool:
+        return packet.get("type", None) == MessageType.ImsgLogin.value and packet.get("binary", None) is True and self.ConnectedServer.BinaryProtocol
 
     def command(self, msg: str):
         arr = msg[1:].split(" ")
@@ -353,6 +553,7 @@ class Client:
                     return
                 
                 self.Admin = True
+                self.Dirty = True
                 self.nickname(username)
 
                 self.server_pm("You are now logged in.")
@@ -369,10 +570,9 @@ class Client:
                 self.ConnectedServer.change_password(self.Name, password)
 
             case "who":
-                with self.ConnectedServer.ClientMutex:
-                    for id, client in self.ConnectedServer.Clients.items():
-                        if client.Lobby == self.Lobby and client.Active and client.LoggedIn:
-                            self.server_pm(f"> {client.Name} ({client.ID})")
+                for client in self.ConnectedServer.lobby_members(self.Lobby):
+                    if client.Active and client.LoggedIn:
+                        self.server_pm(f"> {client.Name} ({client.ID})")
 
             case "pm":
                 if len(args) < 2:
@@ -383,16 +583,20 @@ class Client:
                 msg = " ".join(args[1:])
                 found = False
 
-                with self.ConnectedServer.ClientMutex:
-                    for _, client in self.ConnectedServer.Clients.items():
-                        if client.Name == name:
-                            client.pm(Message(
-                                Body = msg,
-                                Username = self.Name,
-                                Id = self.ID
-                            ))
-                            found = True
-                            break
+                client = self.ConnectedServer.find_name(name)
+
+                # The front asks the other shards one at a time, the sender hears back once it's delivered or nobody has the name
+                if client is None and self.ConnectedServer.Cluster is not None:
+                    self.ConnectedServer.Cluster.send("pm", self.ID, self.Name, name, msg)
+                    return
+
+                if client is not None:
+                    client.pm(Message(
+                        Body = msg,
+                        Username = self.Name,
+                        Id = self.ID
+                    ))
+                    found = True
 
                 if found:
                     self.pm(Message(
@@ -470,53 +674,49 @@ class Client:
                 self.server_pm(f"Unknown command: {cmd}")
 
     def nickname(self, name: str):
-        name = PTUtils.clean_name(name, self.ConnectedServer.BadWords)
+        name = PTUtils.clean_name(name, self.ConnectedServer.Filter)
 
         if name == self.Name:
             return
         
-        should_close = None
-        with self.ConnectedServer.ClientMutex:
-            if self.Admin:
-                for id, client in self.ConnectedServer.Clients.items():
-                    if client.Name == name and client.ID != self.ID:
-                        should_close = client
-            else:
-                nm = name
-
-                while True:
-                    for _, client in self.ConnectedServer.Clients.items():
-                        if client.Name == nm:
-                            nm += str(random.randint(0, 9))
-                            break
-                    else:
-                        name = nm
-                        break
+        name, should_close = self.ConnectedServer.claim_name(self, name, self.Admin)
 
         if should_close:
             should_close.close(MessageType.MsgNone, "")                        
         
         self.Name = name
+        self.Dirty = True
 
     def append(self, msg: CompactMessage):
         with self.QueueMutex:
+            if len(self.Queue) > 0:
+                last = self.Queue[-1]
+
+                # Repeats of the last message are dropped, and for batching clients announcements in a row are sent as one
+                if last.Type == msg.Type and last.Msg == msg.Msg:
+                    return
+
+                if self.Batch > 1 and last.Type == msg.Type == MessageType.OmsgAnnouncement:
+                    self.Queue[-1] = CompactMessage(last.Type, f"{last.Msg}\n{msg.Msg}")
+                    return
+
+            if len(self.Queue) >= self.ConnectedServer.MaxQueue:
+                # Too slow to keep up, it gets kicked on its next update
+                self.QueueOverflow = True
+                return
+
             self.Queue.append(msg)
 
     def direct(self, msg: CompactMessage):
-        data = json.dumps(msg.to_json()).encode()
         try:
-            self.Conn.sendall(data)
+            data = self.encode_message(msg.Type, msg.Msg)
+            with self.SendMutex:
+                self.Conn.send(data)
         except:
             pass
 
     def pm(self, msg: Message):
-        msg.Mid = random.randint(0, 1000000)
-
-        with self.ChatMutex:
-            if len(self.Chat) > 32:
-                self.Chat.pop(0)
-
-            self.Chat.append(msg)
+        self.Chat.add(msg)
 
     def server_pm(self, msg: str):
         self.pm(Message(
@@ -525,7 +725,10 @@ class Client:
             Id = -1
         ))
 
-@dataclass
+def limiter(rate: float, burst: int) -> PTUtils.TokenBucket | None:
+    return PTUtils.TokenBucket(rate, burst) if rate > 0 else None
+
+@dataclass(slots=True)
 class ClientData:
     Type: int = MessageType.ImsgDefault.value
     Msg: str = ""
@@ -546,8 +749,17 @@ class ClientData:
     PaletteTexture: str = ""
     Color: str = ""
 
+    Ver: str = ""
     MsgId: int = 0
 
+    # Delta updates, asked for on login and acknowledged by sequence number
+    Delta: bool = False
+    Ack: int = 0
+    # Switch to the binary protocol after logging in
+    Binary: bool = False
+    # Take several queued messages in one send, newline separated
+    Batch: bool = False
+
     def to_json(self):
         return {
             "type": self.Type,
@@ -566,15 +778,96 @@ class ClientData:
             "paletteSprite": self.PaletteSprite,
             "paletteTexture": self.PaletteTexture,
             "color": self.Color,
-            "msgId": self.MsgId
+            "ver": self.Ver,
+            "msgId": self.MsgId,
+            "delta": self.Delta,
+            "ack": self.Ack,
+            "binary": self.Binary,
+            "batch": self.Batch
         }
     
     @classmethod
     def from_dict(cls, data: dict[str, any]):
+        """ Builds a packet from known keys only, raises ValueError if a value can't be turned into the type its field needs. """
         template = cls()
 
         for key, value in data.items():
-            trueKey = key[0].upper() + key[1:]
-            setattr(template, trueKey, value)
-
-        return template
\ No newline at end of file
+            field = FIELDS.get(key, None)
+
+            # A null is the same as leaving the key out
+            if field is None or value is None:
+                continue
+
+            if not isinstance(value, field[1]):
+                value = coerce(key, value, field[1])
+
+            setattr(template, field[0], value)
+
+        return template
+
+    def update(self, other: ClientData):
+        """ Copies the player state of a newer packet into this one. """
+        self.X = other.X
+        self.Y = other.Y
+        self.Room = other.Room
+        self.Sprite = other.Sprite
+        self.Frame = other.Frame
+        self.Dir = other.Dir
+        self.Palette = other.Palette
+        self.PaletteSprite = other.PaletteSprite
+        self.PaletteTexture = other.PaletteTexture
+        self.Color = other.Color
+
+NUMBER = (int, float)
+BOOLEANS = {"0": False, "1": True, "false": False, "true": True}
+
+def coerce(key: str, value: any, types: type | tuple[type, ...]) -> any:
+    """ Converts numeric strings (and whole floats for int fields) and 0 / 1 / "true" / "false" for flags, anything else fails the whole packet. """
+    try:
+        if types is bool:
+            if isinstance(value, (int, float)) and value in (0, 1):
+                return bool(value)
+
+            if isinstance(value, str) and value.strip().lower() in BOOLEANS:
+                return BOOLEANS[value.strip().lower()]
+        elif types is int:
+            if isinstance(value, str):
+                return int(value)
+
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+        elif types == NUMBER and isinstance(value, str):
+            number = float(value)
+
+            if math.isfinite(number):
+                return number
+    except ValueError:
+        pass
+
+    raise ValueError(f"Invalid value for '{key}': {value!r}")
+
+# JSON key to ClientData attribute and the types it accepts, rooms are used as index keys so only plain values are allowed
+FIELDS: dict[str, tuple[str, type | tuple[type, ...]]] = {
+    "type": ("Type", int),
+    "msg": ("Msg", str),
+    "name": ("Name", str),
+    "version": ("Version", str),
+    "ver": ("Ver", str),
+    "lobby": ("Lobby", str),
+    "key": ("Key", str),
+    "x": ("X", NUMBER),
+    "y": ("Y", NUMBER),
+    "room": ("Room", (int, float, str)),
+    "sprite": ("Sprite", str),
+    "frame": ("Frame", NUMBER),
+    "dir": ("Dir", NUMBER),
+    "palette": ("Palette", NUMBER),
+    "paletteSprite": ("PaletteSprite", str),
+    "paletteTexture": ("PaletteTexture", str),
+    "color": ("Color", str),
+    "msgId": ("MsgId", int),
+    "delta": ("Delta", bool),
+    "ack": ("Ack", int),
+    "binary": ("Binary", bool),
+    "batch": ("Batch", bool)
+}
\ No newline at end of file
@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+import struct
+
+from .messages import MessageType
+
+# Every frame is a big-endian u32 length followed by a payload starting with a u8 MessageType
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME = 1 << 20
+
+# Queued messages can share a type with state responses (OmsgDefault), so their type byte has this bit set
+MESSAGE_FLAG = 0x80
+
+# Interned strings are sent as a u16 index. NEW_STRING defines the next index and LITERAL sends a string that isn't kept,
+# both are followed by a u8 length and the bytes
+NEW_STRING = 0xFFFF
+LITERAL = 0xFFFE
+# Strings and bytes of them each side keeps per direction, past that strings are sent as literals and a peer defining more is refused
+MAX_STRINGS = 4096
+MAX_STRING_BYTES = 64 * 1024
+
+DEFAULT_IN = struct.Struct(">ffiHbHI")    # x, y, room, frame, dir, palette, ack
+DEFAULT_OUT = struct.Struct(">IBHH")      # id, flags, onlineCnt, client count
+CLIENT_OUT = struct.Struct(">IffiHbHB")   # id, x, y, room, frame, dir, palette, admin
+MESSAGE_OUT = struct.Struct(">Ii")        # mid, id
+U16 = struct.Struct(">H")
+
+class CodecError(Exception):
+    pass
+
+class BinaryCodec:
+    """ Length-prefixed binary framing with fixed-width numbers and per-direction string interning, one per connection. """
+    def __init__(self, max_frame: int = MAX_FRAME):
+        self.MaxFrame: int = max_frame
+        self.Buffer: bytearray = bytearray()
+
+        # Strings the peer has already seen from us, and strings it has defined for us
+        self.Outgoing: dict[str, int] = {}
+        self.Incoming: list[str] = []
+        self.OutgoingBytes: int = 0
+        self.IncomingBytes: int = 0
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """ Buffers received bytes and returns every complete frame payload. """
+        self.Buffer += data
+        frames = []
+        offset = 0
+
+        while len(self.Buffer) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.Buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+
+            if length > self.MaxFrame:
+                self.Buffer.clear()
+                raise CodecError(f"Frame too large ({length} bytes)")
+
+            if end > len(self.Buffer):
+                break
+
+            frames.append(bytes(self.Buffer[offset + FRAME_HEADER.size:end]))
+            offset = end
+
+        del self.Buffer[:offset]
+        return frames
+
+    def decode(self, payload: bytes) -> dict:
+        """ Decodes a client frame into the same dict the JSON protocol would produce. """
+        if len(payload) == 0:
+            raise CodecError("Empty frame")
+
+        type = payload[0]
+        offset = 1
+
+        match type:
+            case MessageType.ImsgDefault.value:
+                x, y, room, frame, dir, palette, ack = DEFAULT_IN.unpack_from(payload, offset)
+                offset += DEFAULT_IN.size
+
+                sprite, offset = self.read_interned(payload, offset)
+                paletteSprite, offset = self.read_interned(payload, offset)
+                paletteTexture, offset = self.read_interned(payload, offset)
+                color, offset = self.read_interned(payload, offset)
+
+                return {
+                    "type": type,
+                    "x": x,
+                    "y": y,
+                    "room": room,
+                    "sprite": sprite,
+                    "frame": frame,
+                    "dir": dir,
+                    "palette": palette,
+                    "paletteSprite": paletteSprite,
+                    "paletteTexture": paletteTexture,
+                    "color": color,
+                    "ack": ack
+                }
+
+            case MessageType.ImsgPaused.value:
+                return {"type": type}
+
+            case MessageType.ImsgMessage.value:
+                msg, offset = read_string(payload, offset)
+                return {"type": type, "msg": msg}
+
+        raise CodecError(f"Unknown frame type {type}")
+
+    def read_interned(self, payload: bytes, offset: int) -> tuple[str, int]:
+        index, = U16.unpack_from(payload, offset)
+        offset += U16.size
+
+        if index != NEW_STRING and index != LITERAL:
+            if index >= len(self.Incoming):
+                raise CodecError(f"Unknown string index {index}")
+
+            return self.Incoming[index], offset
+
+        length = payload[offset]
+        value = payload[offset + 1:offset + 1 + length].decode()
+
+        if index == NEW_STRING:
+            # Every string defined is kept for the whole connection, so the peer only gets so many
+            if len(self.Incoming) >= MAX_STRINGS or self.IncomingBytes + length > MAX_STRING_BYTES:
+                raise CodecError(f"Too many interned strings ({len(self.Incoming)}, {self.IncomingBytes} bytes)")
+
+            self.Incoming.append(value)
+            self.IncomingBytes += length
+
+        return value, offset + 1 + length
+
+    def write_interned(self, out: bytearray, value: str):
+        index = self.Outgoing.get(value, None)
+
+        if index is not None:
+            out += U16.pack(index)
+            return
+
+        raw = truncate(value, 255)
+
+        if len(self.Outgoing) < MAX_STRINGS and self.OutgoingBytes + len(raw) <= MAX_STRING_BYTES:
+            out += U16.pack(NEW_STRING)
+            self.Outgoing[value] = len(self.Outgoing)
+            self.OutgoingBytes += len(raw)
+        else:
+            out += U16.pack(LITERAL)
+
+        out.append(len(raw))
+        out += raw
+
+    def encode_default(self, id: int, logged_in: bool, admin: bool, name: str, online: int, clients: list[dict], msgs: list[dict]) -> bytes:
+        """ Encodes an OmsgDefault response from CompactClient and Message dicts. """
+        out = bytearray([MessageType.OmsgDefault.value])
+        out += DEFAULT_OUT.pack(id, logged_in | admin << 1, min(online, 0xFFFF), len(clients))
+        write_string(out, name, 1)
+
+        for client in clients:
+            out += CLIENT_OUT.pack(
+                client["id"],
+                number(client["x"]),
+                number(client["y"]),
+                integer(client["room"]),
+                integer(client["frame"]) & 0xFFFF,
+                max(-128, min(127, integer(client["dir"]))),
+                integer(client["palette"]) & 0xFFFF,
+                client["admin"]
+            )
+
+            self.write_interned(out, str(client["sprite"]))
+            self.write_interned(out, str(client["paletteSprite"]))
+            self.write_interned(out, str(client["paletteTexture"]))
+            self.write_interned(out, str(client["color"]))
+            write_string(out, client["name"], 1)
+
+        out += U16.pack(len(msgs))
+
+        for msg in msgs:
+            out += MESSAGE_OUT.pack(msg["mid"], msg["id"])
+            write_string(out, msg["username"], 1)
+            write_string(out, msg["body"], 2)
+
+        return frame(out)
+
+    def encode_message(self, type: int, msg: str) -> bytes:
+        """ Encodes a CompactMessage (queued broadcasts, kicks and disconnects). """
+        out = bytearray([type | MESSAGE_FLAG])
+        write_string(out, msg, 2)
+
+        return frame(out)
+
+    # The client side of the protocol, used by tools that speak it
+
+    def encode_packet(self, data: dict) -> bytes:
+        """ Encodes a client packet dict (as sent in JSON) into a frame. """
+        type = data["type"]
+        out = bytearray([type])
+
+        match type:
+            case MessageType.ImsgDefault.value:
+                out += DEFAULT_IN.pack(
+                    number(data.get("x", 0)),
+                    number(data.get("y", 0)),
+                    integer(data.get("room", 0)),
+                    integer(data.get("frame", 0)) & 0xFFFF,
+                    max(-128, min(127, integer(data.get("dir", 0)))),
+                    integer(data.get("palette", 0)) & 0xFFFF,
+                    integer(data.get("ack", 0)) & 0xFFFFFFFF
+                )
+
+                self.write_interned(out, str(data.get("sprite", "")))
+                self.write_interned(out, str(data.get("paletteSprite", "")))
+                self.write_interned(out, str(data.get("paletteTexture", "")))
+                self.write_interned(out, str(data.get("color", "")))
+
+            case MessageType.ImsgMessage.value:
+                write_string(out, data.get("msg", ""), 2)
+
+        return frame(out)
+
+    def decode_response(self, payload: bytes) -> dict:
+        """ Decodes a server frame into the same dict the JSON protocol would produce. """
+        type = payload[0]
+
+        if type & MESSAGE_FLAG:
+            msg, _ = read_string(payload, 1)
+            return {"type": type & ~MESSAGE_FLAG, "msg": msg}
+
+        id, flags, online, count = DEFAULT_OUT.unpack_from(payload, 1)
+        name, offset = read_short_string(payload, 1 + DEFAULT_OUT.size)
+        clients = []
+
+        for _ in range(count):
+            cid, x, y, room, frame, dir, palette, admin = CLIENT_OUT.unpack_from(payload, offset)
+            offset += CLIENT_OUT.size
+
+            sprite, offset = self.read_interned(payload, offset)
+            paletteSprite, offset = self.read_interned(payload, offset)
+            paletteTexture, offset = self.read_interned(payload, offset)
+            color, offset = self.read_interned(payload, offset)
+            cname, offset = read_short_string(payload, offset)
+
+            clients.append({
+                "id": cid,
+                "x": x,
+                "y": y,
+                "name": cname,
+                "admin": bool(admin),
+                "room": room,
+                "sprite": sprite,
+                "frame": frame,
+                "dir": dir,
+                "palette": palette,
+                "paletteSprite": paletteSprite,
+                "paletteTexture": paletteTexture,
+                "color": color
+            })
+
+        count, = U16.unpack_from(payload, offset)
+        offset += U16.size
+        msgs = []
+
+        for _ in range(count):
+            mid, mid_id = MESSAGE_OUT.unpack_from(payload, offset)
+            username, offset = read_short_string(payload, offset + MESSAGE_OUT.size)
+            body, offset = read_string(payload, offset)
+
+            msgs.append({"body": body, "username": username, "id": mid_id, "mid": mid})
+
+        return {
+            "clients": clients,
+            "msgs": msgs,
+            "type": type,
+            "loggedIn": bool(flags & 1),
+            "admin": bool(flags & 2),
+            "name": name,
+            "id": id,
+            "onlineCnt": online
+        }
+
+def frame(payload: bytearray) -> bytes:
+    if len(payload) > MAX_FRAME:
+        raise CodecError(f"Frame too large ({len(payload)} bytes)")
+
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def read_string(payload: bytes, offset: int) -> tuple[str, int]:
+    length, = U16.unpack_from(payload, offset)
+    offset += U16.size
+
+    return payload[offset:offset + length].decode(), offset + length
+
+def read_short_string(payload: bytes, offset: int) -> tuple[str, int]:
+    length = payload[offset]
+    offset += 1
+
+    return payload[offset:offset + length].decode(), offset + length
+
+def write_string(out: bytearray, value: str, width: int):
+    """ Writes a string prefixed with a u8 (width 1) or u16 (width 2) byte length. """
+    raw = truncate(value, (1 << 8 * width) - 1)
+    out += len(raw).to_bytes(width, "big")
+    out += raw
+
+def truncate(value: str, limit: int) -> bytes:
+    raw = value.encode()
+
+    if len(raw) <= limit:
+        return raw
+
+    # Don't cut a multi-byte character in half
+    return raw[:limit].decode(errors="ignore").encode()
+
+# Client data is not validated, so fall back to 0 rather than failing the whole response
+def number(value) -> float:
+    return float(value) if isinstance(value, (int, float)) and abs(value) < 3.4e38 else 0.0
+
+def integer(value) -> int:
+    return int(value) if isinstance(value, (int, float)) and value == value and abs(value) < 2 ** 31 else 0
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import socket
+
+# Sends that return instead of waiting for room in the socket buffer, Windows has no such flag so sends block there
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+class SocketConnection:
+    """
+    A client socket for the threaded engine. Reads block on the client's own thread, sends never block:
+    whatever the socket doesn't take right away waits in Pending until the next send or flush.
+    Not thread-safe on its own, callers send under the client's SendMutex.
+    """
+    def __init__(self, sock: socket.socket):
+        self.Socket: socket.socket = sock
+        self.Pending: bytearray = bytearray()
+
+    def recv(self, size: int) -> bytes:
+        return self.Socket.recv(size)
+
+    def send(self, data: bytes):
+        if len(self.Pending) > 0:
+            self.Pending += data
+            self.flush()
+            return
+
+        sent = self.write(data)
+
+        if sent < len(data):
+            self.Pending += memoryview(data)[sent:]
+
+    def flush(self) -> int:
+        """ Sends as much of the pending data as the socket takes, returns how much is left. """
+        if len(self.Pending) > 0:
+            del self.Pending[:self.write(self.Pending)]
+
+        return len(self.Pending)
+
+    def pending(self) -> int:
+        return len(self.Pending)
+
+    def write(self, data: bytes | bytearray) -> int:
+        try:
+            return self.Socket.send(data, MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    def close(self):
+        self.Socket.close()
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+class DeltaTracker:
+    """ Remembers what was sent to a client per sequence number, so responses only carry what changed since its last ack. """
+    def __init__(self, keyframe: int, history: int = 64):
+        self.Keyframe: int = keyframe
+        self.HistoryLength: int = history
+
+        self.Seq: int = 0
+        self.Acked: int = 0
+        self.LastKey: int = 0
+        self.History: dict[int, tuple[dict[int, dict], set[int]]] = {}
+
+    def ack(self, seq: int):
+        """ Marks everything sent up to seq as received by the client. """
+        if not isinstance(seq, int) or seq <= self.Acked or seq not in self.History:
+            return
+
+        self.Acked = seq
+
+    def encode(self, states: dict[int, dict], msgs: list[dict]) -> dict:
+        """ Returns the response fields for the given full state, as a keyframe or a delta against the last ack. """
+        self.Seq += 1
+
+        base = self.History.get(self.Acked, None)
+
+        if base is None or self.Seq - self.LastKey >= self.Keyframe or len(msgs) < len(base[1]):
+            # Nothing usable to diff against, the keyframe is due or the chat was cleared
+            fields = {
+                "seq": self.Seq,
+                "key": True,
+                "clients": list(states.values()),
+                "msgs": msgs
+            }
+
+            self.LastKey = self.Seq
+        else:
+            base_states, base_mids = base
+            clients = []
+            joined = []
+
+            for id, state in states.items():
+                old = base_states.get(id, None)
+
+                if old is None:
+                    clients.append(state)
+                    joined.append(id)
+                    continue
+
+                # Cached entries are only replaced when a client changes, so the same dict means nothing to send
+                if old is state:
+                    continue
+
+                changed = {key: value for key, value in state.items() if old.get(key, None) != value}
+                if len(changed) > 0:
+                    changed["id"] = id
+                    clients.append(changed)
+
+            fields = {
+                "seq": self.Seq,
+                "base": self.Acked,
+                "clients": clients,
+                "joined": joined,
+                "left": [id for id in base_states if id not in states],
+                "msgs": [msg for msg in msgs if msg["mid"] not in base_mids]
+            }
+
+        self.History[self.Seq] = (states, {msg["mid"] for msg in msgs})
+        self.History.pop(self.Seq - self.HistoryLength, None)
+
+        return fields
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import threading
+
+from . import client
+from .chat import ChatLog, MessageIds
+
+class Lobby:
+    """
+    Members, rooms and chat of one lobby.
+
+    The member and room dicts are never changed once published: writers build a copy under Mutex
+    and swap it in, so readers can use whatever dict they get without taking a lock.
+    """
+    def __init__(self, name: str, ids: MessageIds):
+        self.Name: str = name
+        self.Members: dict[int, client.Client] = {}
+        self.Rooms: dict[int, dict[int, client.Client]] = {}
+        # The room each member is indexed under, only used under Mutex
+        # A client's Data.Room changes after it has been moved, so removing by it could miss the room it's really in
+        self.Placed: dict[int, int] = {}
+        self.Chat: ChatLog = ChatLog(ids)
+        self.Mutex: threading.Lock = threading.Lock()
+
+    def add(self, c: client.Client):
+        with self.Mutex:
+            members = dict(self.Members)
+            members[c.ID] = c
+            self.Members = members
+
+            self._add_room(c, c.Data.Room)
+
+    def remove(self, c: client.Client) -> bool:
+        """ Removes the client, returns False if it wasn't a member. """
+        with self.Mutex:
+            if c.ID not in self.Members:
+                return False
+
+            members = dict(self.Members)
+            del members[c.ID]
+            self.Members = members
+
+            self._remove_room(c)
+
+        return True
+
+    def move(self, c: client.Client, room: int):
+        with self.Mutex:
+            if c.ID not in self.Members:
+                return
+
+            self._remove_room(c)
+            self._add_room(c, room)
+
+    def room(self, room: int) -> dict[int, client.Client]:
+        return self.Rooms.get(room, {})
+
+    def _add_room(self, c: client.Client, room: int):
+        self.Placed[c.ID] = room
+
+        members = dict(self.Rooms.get(room, {}))
+        members[c.ID] = c
+
+        rooms = dict(self.Rooms)
+        rooms[room] = members
+        self.Rooms = rooms
+
+    def _remove_room(self, c: client.Client):
+        room = self.Placed.pop(c.ID, None)
+        if c.ID not in self.Rooms.get(room, {}):
+            return
+
+        members = dict(self.Rooms[room])
+        del members[c.ID]
+
+        rooms = dict(self.Rooms)
+        if len(members) > 0:
+            rooms[room] = members
+        else:
+            del rooms[room]
+
+        self.Rooms = rooms
@@ -1,3 +1,5 @@
+import json
+
 from dataclasses import dataclass
 from enum import Enum
 
@@ -14,7 +16,7 @@ class MessageType(Enum):
     OmsgKick = 8
     OmsgAnnouncement = 9
 
-@dataclass
+@dataclass(slots=True)
 class CompactMessage:
     Type: int
     Msg: str
@@ -25,7 +27,7 @@ class CompactMessage:
             "msg": self.Msg
         }
 
-@dataclass
+@dataclass(slots=True)
 class CompactClient:
     ID: int
     X: float
@@ -59,7 +61,7 @@ class CompactClient:
             "color": self.Color
         }
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     Body: str
     Username: str
@@ -72,4 +74,18 @@ class Message:
             "username": self.Username,
             "id": self.Id,
             "mid": self.Mid
-        }
\ No newline at end of file
+        }
+
+def encode_response(data: dict, **raw: str) -> bytes:
+    """ Encodes data as JSON, splicing in values from raw that are already serialized. """
+    body = json.dumps(data)
+
+    if len(raw) == 0:
+        return body.encode()
+
+    spliced = ", ".join(f'"{key}": {value}' for key, value in raw.items())
+
+    if len(data) == 0:
+        return ("{" + spliced + "}").encode()
+
+    return ("{" + spliced + ", " + body[1:]).encode()
@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import bisect
+import http.server
+import threading
+import time
+
+from . import client
+from . import server
+
+# Histogram bucket upper bounds in seconds, doubling from 1µs to about 1s
+TIME_BUCKETS = tuple(1e-6 * 2 ** i for i in range(21))
+
+PHASES = ("recv", "parse", "build", "serialize", "send")
+LOCKS = ("ClientMutex", "ChatMutex", "QueueMutex")
+
+class Histogram:
+    """
+    Counts observations into fixed buckets.
+    Updates aren't locked, under the GIL the odd lost increment is all that can go wrong, which is fine for statistics.
+    """
+    def __init__(self, bounds: tuple[float, ...] = TIME_BUCKETS):
+        self.Bounds: tuple[float, ...] = bounds
+        self.Counts: list[int] = [0] * (len(bounds) + 1)
+        self.Sum: float = 0
+        self.Count: int = 0
+
+    def observe(self, value: float):
+        self.Counts[bisect.bisect_left(self.Bounds, value)] += 1
+        self.Sum += value
+        self.Count += 1
+
+    def percentile(self, p: float) -> float:
+        """ Returns the upper bound of the bucket the given percentile falls in, inf if it's past the last one. """
+        target = self.Count * p / 100
+        seen = 0
+
+        for bound, count in zip(self.Bounds, self.Counts):
+            seen += count
+            if seen >= target and seen > 0:
+                return bound
+
+        return float("inf") if self.Count > 0 else 0
+
+class TimedLock:
+    """ Lock that records how long acquiring it took, only when it had to wait, so uncontended use stays cheap. """
+    def __init__(self, histogram: Histogram):
+        self.Lock: threading.Lock = threading.Lock()
+        self.Waits: Histogram = histogram
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self.Lock.acquire(False):
+            return True
+
+        if not blocking:
+            return False
+
+        start = time.perf_counter()
+        acquired = self.Lock.acquire(True, timeout)
+        self.Waits.observe(time.perf_counter() - start)
+
+        return acquired
+
+    def release(self):
+        self.Lock.release()
+
+    def locked(self) -> bool:
+        return self.Lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.Lock.release()
+
+class Metrics:
+    """ Server-wide counters and histograms, exposed through /stats and an optional Prometheus endpoint. """
+    def __init__(self, server: server.Server, enabled: bool = True, sample: int = 16):
+        self.ConnectedServer: server.Server = server
+        self.Enabled: bool = enabled
+        # Every Nth loop iteration of a client is timed
+        self.Sample: int = sample if enabled else 0
+
+        self.Phases: dict[str, Histogram] = {phase: Histogram() for phase in PHASES}
+        self.LockWaits: dict[str, Histogram] = {name: Histogram() for name in LOCKS}
+        self.QueueDepth: Histogram = Histogram((0,) + tuple(2 ** i for i in range(11)))
+        # Every scheduler tick, from building the world to the last client's update
+        self.Ticks: Histogram = Histogram()
+
+        self.ParseFailures: int = 0
+        # Traffic of clients that have already closed, live clients keep their own counters
+        self.BytesIn: int = 0
+        self.BytesOut: int = 0
+        self.PacketsIn: int = 0
+        self.PacketsOut: int = 0
+
+        # Time the current thread spent building or waiting for room snapshots, kept out of its serialize phase
+        self.Local: threading.local = threading.local()
+
+        self.Started: float = time.monotonic()
+        self.Http: http.server.ThreadingHTTPServer | None = None
+
+    def lock(self, name: str) -> threading.Lock | TimedLock:
+        return TimedLock(self.LockWaits[name]) if self.Enabled else threading.Lock()
+
+    def sample(self, c: client.Client) -> bool:
+        """ Decides whether this loop iteration of the client gets timed. """
+        if self.Sample <= 0:
+            return False
+
+        c.Iterations += 1
+        return c.Iterations % self.Sample == 0
+
+    def building(self, seconds: float):
+        self.Local.Build = getattr(self.Local, "Build", 0) + seconds
+
+    def take_build(self) -> float:
+        """ Returns the snapshot build time of this thread since the last call. """
+        seconds = getattr(self.Local, "Build", 0)
+        self.Local.Build = 0
+
+        return seconds
+
+    def retire(self, c: client.Client):
+        """ Keeps the traffic of a closing client in the totals. """
+        self.BytesIn += c.BytesIn
+        self.BytesOut += c.BytesOut
+        self.PacketsIn += c.PacketsIn
+        self.PacketsOut += c.PacketsOut
+
+    def totals(self) -> dict[str, int]:
+        totals = {
+            "bytes_in": self.BytesIn,
+            "bytes_out": self.BytesOut,
+            "packets_in": self.PacketsIn,
+            "packets_out": self.PacketsOut
+        }
+
+        for c in self.ConnectedServer.Clients.values():
+            totals["bytes_in"] += c.BytesIn
+            totals["bytes_out"] += c.BytesOut
+            totals["packets_in"] += c.PacketsIn
+            totals["packets_out"] += c.PacketsOut
+
+        return totals
+
+    def clients(self, count: int = 5) -> list[client.Client]:
+        """ Returns the clients with the most traffic. """
+        return sorted(self.ConnectedServer.Clients.values(), key=lambda c: c.BytesIn + c.BytesOut, reverse=True)[:count]
+
+    def lobbies(self) -> dict[str, int]:
+        return {name: len(lobby.Members) for name, lobby in self.ConnectedServer.Lobbies.items()}
+
+    def queues(self) -> Histogram:
+        """ Returns the current queue depth of every client, sampled now. """
+        depths = Histogram(self.QueueDepth.Bounds)
+
+        for c in self.ConnectedServer.Clients.values():
+            depths.observe(len(c.Queue))
+
+        return depths
+
+    def summary(self) -> list[str]:
+        """ Returns the lines /stats shows. """
+        srv = self.ConnectedServer
+        totals = self.totals()
+        lobbies = self.lobbies()
+        queues = self.queues()
+
+        lines = [
+            f"Up {time.monotonic() - self.Started:.0f}s, {len(srv.Clients)} clients in {len(lobbies)} lobbies",
+            f"In {totals['packets_in']} packets / {totals['bytes_in']} B, out {totals['packets_out']} / {totals['bytes_out']} B",
+            f"Parse failures {self.ParseFailures}, queue depth p99 {queues.percentile(99):g} (max {srv.MaxQueue})"
+        ]
+
+        if self.Sample > 0:
+            lines.append(f"Phases (1 in {self.Sample} iterations), p50 / p99 ms:")
+
+            for phase, histogram in self.Phases.items():
+                lines.append(f"  {phase}: {histogram.percentile(50) * 1000:.3f} / {histogram.percentile(99) * 1000:.3f} ({histogram.Count})")
+
+        if self.Enabled:
+            lines.append("Lock waits, count and p99 ms:")
+
+            for name, histogram in self.LockWaits.items():
+                lines.append(f"  {name}: {histogram.Count}, {histogram.percentile(99) * 1000:.3f}")
+
+        if srv.Scheduler is not None:
+            scheduler = srv.Scheduler
+            lines.append(f"Ticks {scheduler.Ticks}, overruns {scheduler.Overruns}, p99 {self.Ticks.percentile(99) * 1000:.3f}ms, max {scheduler.MaxDuration * 1000:.2f}ms")
+
+        busiest = sorted(lobbies.items(), key=lambda item: item[1], reverse=True)[:5]
+        if len(busiest) > 0:
+            lines.append("Lobbies: " + ", ".join(f"{name} ({count})" for name, count in busiest))
+
+        top = self.clients()
+        if len(top) > 0:
+            lines.append("Top clients, packets / B in and out:")
+
+            for c in top:
+                lines.append(f"  {c.ID} {c.Name or '-'}: in {c.PacketsIn} / {c.BytesIn}, out {c.PacketsOut} / {c.BytesOut}")
+
+        return lines
+
+    def prometheus(self) -> str:
+        """ Returns every metric in the Prometheus text format. """
+        srv = self.ConnectedServer
+        out = []
+
+        def metric(name: str, kind: str, help: str):
+            out.append(f"# HELP ptt_{name} {help}")
+            out.append(f"# TYPE ptt_{name} {kind}")
+
+        def histogram(name: str, labels: str, h: Histogram):
+            seen = 0
+            prefix = labels + "," if labels else ""
+
+            for bound, count in zip(h.Bounds, h.Counts):
+                seen += count
+                out.append(f'ptt_{name}_bucket{{{prefix}le="{bound:g}"}} {seen}')
+
+            out.append(f'ptt_{name}_bucket{{{prefix}le="+Inf"}} {h.Count}')
+
+            suffix = f"{{{labels}}}" if labels else ""
+            out.append(f"ptt_{name}_sum{suffix} {h.Sum}")
+            out.append(f"ptt_{name}_count{suffix} {h.Count}")
+
+        metric("clients", "gauge", "Connected clients.")
+        out.append(f"ptt_clients {len(srv.Clients)}")
+
+        metric("lobby_clients", "gauge", "Logged in clients per lobby.")
+        for name, count in self.lobbies().items():
+            out.append(f'ptt_lobby_clients{{lobby="{escape(name)}"}} {count}')
+
+        for name, value in self.totals().items():
+            metric(f"{name}_total", "counter", f"Total {name.replace('_', ' ')}.")
+            out.append(f"ptt_{name}_total {value}")
+
+        metric("parse_failures_total", "counter", "Packets that failed to parse.")
+        out.append(f"ptt_parse_failures_total {self.ParseFailures}")
+
+        metric("phase_seconds", "histogram", "Sampled time spent in each phase of a client loop iteration.")
+        for phase, h in self.Phases.items():
+            histogram("phase_seconds", f'phase="{phase}"', h)
+
+        metric("lock_wait_seconds", "histogram", "Time spent waiting for a contended lock.")
+        for name, h in self.LockWaits.items():
+            histogram("lock_wait_seconds", f'lock="{name}"', h)
+
+        metric("queue_depth", "histogram", "Queued messages per client right now.")
+        histogram("queue_depth", "", self.queues())
+
+        if srv.Scheduler is not None:
+            metric("tick_overruns_total", "counter", "Ticks that took longer than the tick interval.")
+            out.append(f"ptt_tick_overruns_total {srv.Scheduler.Overruns}")
+
+            metric("tick_seconds", "histogram", "Time each tick took to build the world and update every client.")
+            histogram("tick_seconds", "", self.Ticks)
+
+        return "\n".join(out) + "\n"
+
+    def serve_http(self, host: str, port: int):
+        """ Serves the Prometheus metrics on a background thread. """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.Http = http.server.ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"Failed to serve metrics on {host}:{port}: {e}")
+            return
+
+        threading.Thread(target=self.Http.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{host}:{port}/metrics")
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
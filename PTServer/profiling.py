@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+import PTUtils
+
+from . import client
+from . import server
+
+# How many functions the summary sent back to the admin lists
+TOP = 10
+# Innermost frames of threads that are waiting rather than working, by file and function
+IDLE = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("connection.py", "_recv"),
+    ("connection.py", "recv"),
+}
+
+def location(code) -> str:
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Sampler:
+    """ Statistical profiler, records the stack of every thread at a fixed interval. """
+    def __init__(self, interval: float):
+        self.Interval: float = interval
+        self.Samples: int = 0
+        self.IdleSamples: int = 0
+
+        self.Stacks: collections.Counter[str] = collections.Counter()
+        # Samples a function was the innermost frame in, and samples it was anywhere on the stack
+        self.Own: collections.Counter[str] = collections.Counter()
+        self.Total: collections.Counter[str] = collections.Counter()
+
+        # Blocking in recv or a sleep leaves these as the innermost frame, so they count as idle too
+        self.IdleCode = {client.Client.loop.__code__, PTUtils.Ticker.tick.__code__}
+
+    def sample(self):
+        own = threading.get_ident()
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+
+            self.Samples += 1
+            code = frame.f_code
+
+            if code in self.IdleCode or (os.path.basename(code.co_filename), code.co_name) in IDLE:
+                self.IdleSamples += 1
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(location(frame.f_code))
+                frame = frame.f_back
+
+            self.Own[stack[0]] += 1
+            self.Total.update(set(stack))
+            self.Stacks[";".join(reversed(stack))] += 1
+
+    def run(self, duration: float, stopped: threading.Event):
+        end = time.monotonic() + duration
+
+        while time.monotonic() < end and not stopped.wait(self.Interval):
+            self.sample()
+
+    def write(self, path: str):
+        """ Writes the busy stacks in the collapsed format flame graph tools read. """
+        with open(path, "w") as f:
+            for stack, count in self.Stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def summary(self) -> list[str]:
+        busy = self.Samples - self.IdleSamples
+        lines = [f"{self.Samples} thread samples, {busy} busy. Own / total % of busy samples:"]
+
+        if busy == 0:
+            return lines
+
+        for name, count in self.Own.most_common(TOP):
+            lines.append(f"  {count * 100 / busy:.1f} / {self.Total[name] * 100 / busy:.1f} {name}")
+
+        return lines
+
+class ClientProfile:
+    """
+    cProfile on one client's thread.
+    cProfile only sees the thread that enables it, so the client's loop switches it on around handling each received chunk.
+    """
+    def __init__(self):
+        self.Profiler: cProfile.Profile = cProfile.Profile()
+        self.Done: bool = False
+        self.Mutex: threading.Lock = threading.Lock()
+
+    def receive(self, c: client.Client, raw: bytes) -> bool:
+        with self.Mutex:
+            if self.Done:
+                return c.receive(raw)
+
+            self.Profiler.enable()
+
+            try:
+                return c.receive(raw)
+            finally:
+                self.Profiler.disable()
+
+    def finish(self):
+        # Waits for a receive in progress, after this the profiler is never enabled again
+        with self.Mutex:
+            self.Done = True
+
+    def summary(self) -> list[str]:
+        # pstats refuses a profiler that never ran, which is what a client that sent nothing leaves behind
+        if len(self.Profiler.getstats()) == 0:
+            return ["No calls recorded, the client sent nothing while it was profiled."]
+
+        stats = pstats.Stats(self.Profiler).stats
+        total = sum(own for _, _, own, _, _ in stats.values())
+        lines = [f"{total * 1000:.1f}ms profiled. Own / cumulative ms, calls:"]
+
+        for (file, line, name), (_, calls, own, cumulative, _) in sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:TOP]:
+            where = f" ({os.path.basename(file)}:{line})" if line > 0 else ""
+            lines.append(f"  {own * 1000:.2f} / {cumulative * 1000:.2f}, {calls} {name}{where}")
+
+        return lines
+
+class Profiling:
+    """ Runs the profiles admins start with commands, one at a time, and the optional slow loop watchdog. """
+    def __init__(self, server: server.Server, directory: str, slow_loop: float = 0):
+        self.ConnectedServer: server.Server = server
+        self.Directory: str = directory
+        self.SlowLoop: float = slow_loop
+
+        self.Running: bool = False
+        self.Stopped: threading.Event = threading.Event()
+        self.Mutex: threading.Lock = threading.Lock()
+
+    def sample(self, admin: client.Client, duration: float, interval: float) -> bool:
+        """ Samples every thread for duration seconds, returns False if a profile is already running. """
+        sampler = Sampler(interval)
+
+        def run():
+            sampler.run(duration, self.Stopped)
+
+            path = self.path("sample", "txt")
+            sampler.write(path)
+            self.report(admin, path, sampler.summary())
+
+        return self.start(run)
+
+    def profile(self, admin: client.Client, target: client.Client, duration: float) -> bool:
+        """ Runs cProfile on the target client's thread for duration seconds, returns False if a profile is already running. """
+        profile = ClientProfile()
+
+        def run():
+            target.Profile = profile
+            self.Stopped.wait(duration)
+            target.Profile = None
+            profile.finish()
+
+            path = self.path(f"client-{target.ID}", "prof")
+            profile.Profiler.dump_stats(path)
+            self.report(admin, path, profile.summary())
+
+        return self.start(run)
+
+    def stop(self) -> bool:
+        """ Ends the running profile early, returns False if there is none. """
+        with self.Mutex:
+            if not self.Running:
+                return False
+
+            self.Stopped.set()
+
+        return True
+
+    def start(self, run):
+        with self.Mutex:
+            if self.Running:
+                return False
+
+            self.Running = True
+            self.Stopped.clear()
+
+        def wrapper():
+            try:
+                run()
+            finally:
+                with self.Mutex:
+                    self.Running = False
+
+        threading.Thread(target=wrapper, daemon=True).start()
+        return True
+
+    def path(self, name: str, extension: str) -> str:
+        os.makedirs(self.Directory, exist_ok=True)
+        return os.path.join(self.Directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+    def report(self, admin: client.Client, path: str, lines: list[str]):
+        print(f"Profile written to {path}")
+
+        if not admin.Active:
+            return
+
+        admin.server_pm(f"Profile written to {path}")
+        for line in lines:
+            admin.server_pm(line)
+
+    def watch(self):
+        """ Logs the stack of every client whose loop iteration has been busy for longer than SlowLoop, once per iteration. """
+        srv = self.ConnectedServer
+        path = os.path.join(self.Directory, "slow_loops.log")
+        reported: dict[client.Client, float] = {}
+        t = PTUtils.Ticker(self.SlowLoop / 2)
+
+        while t.tick():
+            if not srv.Up:
+                return
+
+            now = time.perf_counter()
+            slow = {c: c.Busy for c in srv.Clients.values() if c.Busy > 0 and now - c.Busy > self.SlowLoop}
+            new = [c for c, started in slow.items() if reported.get(c, None) != started]
+            reported = slow
+
+            if len(new) == 0:
+                continue
+
+            frames = sys._current_frames()
+            os.makedirs(self.Directory, exist_ok=True)
+
+            with open(path, "a") as f:
+                for c in new:
+                    frame = frames.get(c.Thread, None)
+                    if frame is None:
+                        continue
+
+                    f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} client {c.ID} ({c.Name}) busy for over {(now - slow[c]) * 1000:.1f}ms:\n")
+                    f.writelines(traceback.format_stack(frame))
+                    f.write("\n")
+
+            print(f"Slow loop iterations from {len(new)} client(s), stacks written to {path}")
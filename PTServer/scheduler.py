@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from . import server
+
+class TickScheduler:
+    """ Builds the world state once per tick and pushes an update to every client at a fixed rate. """
+    def __init__(self, server: server.Server, rate: int):
+        self.ConnectedServer: server.Server = server
+        self.Interval: float = 1 / rate
+
+        self.Ticks: int = 0
+        self.Overruns: int = 0
+        self.SkippedTicks: int = 0
+        self.LastDuration: float = 0
+        self.MaxDuration: float = 0
+        self.TotalDuration: float = 0
+
+        self.ReportInterval: float = 10
+        self.LastReport: float = time.monotonic()
+        self.ReportedOverruns: int = 0
+
+    def tick(self):
+        start = time.perf_counter()
+
+        self.ConnectedServer.World.build()
+
+        for client in self.ConnectedServer.Clients.values():
+            if client.Active:
+                client.respond()
+
+        duration = time.perf_counter() - start
+
+        self.Ticks += 1
+        self.LastDuration = duration
+        self.TotalDuration += duration
+        self.MaxDuration = max(self.MaxDuration, duration)
+        self.ConnectedServer.Metrics.Ticks.observe(duration)
+
+    def schedule(self, next_tick: float) -> float:
+        """ Returns how long to wait for the tick after next_tick, counting overruns. """
+        now = time.perf_counter()
+        delay = next_tick + self.Interval - now
+
+        if delay < 0:
+            # Don't try to catch up, just start again from now
+            self.Overruns += 1
+            self.SkippedTicks += int(-delay // self.Interval)
+            delay = 0
+
+        self.report()
+        return delay
+
+    def report(self):
+        now = time.monotonic()
+        if now - self.LastReport < self.ReportInterval:
+            return
+
+        overruns = self.Overruns - self.ReportedOverruns
+        if overruns > 0:
+            average = self.TotalDuration / max(self.Ticks, 1) * 1000
+            print(f"Warning: {overruns} ticks overran {self.Interval * 1000:.1f}ms in the last {now - self.LastReport:.0f}s (avg {average:.2f}ms, max {self.MaxDuration * 1000:.2f}ms)")
+
+        self.LastReport = now
+        self.ReportedOverruns = self.Overruns
+
+    def run(self):
+        while self.ConnectedServer.Up:
+            next_tick = time.perf_counter()
+            self.tick()
+            time.sleep(self.schedule(next_tick))
+
+    async def run_async(self):
+        while self.ConnectedServer.Up:
+            next_tick = time.perf_counter()
+            self.tick()
+            await asyncio.sleep(self.schedule(next_tick))
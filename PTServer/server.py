@@ -1,15 +1,28 @@
+import asyncio
 import importlib
 import json
 import os
+import random
 import socket
-import time
 import threading
 
 import PTUtils
 import PTCommand
 
 from PTConfig import Config
+from . import admission
+from . import aio
+from . import anticheat
+from . import chat
 from . import client
+from . import connection
+from . import metrics
+from . import profiling
+from . import scheduler
+from . import shards
+from . import timeouts
+from . import world
+from .lobby import Lobby
 from .messages import CompactMessage, MessageType
 
 VERSION = "1.2.4"
@@ -22,17 +35,73 @@ class Server:
         self.Host: str = config.Host
         self.Port: int = config.Port
         self.Timeout: int = config.Timeout
+        self.LoginTimeout: int = config.LoginTimeout
+        self.PausedTimeout: int = config.PausedTimeout
         self.MaxPlayers: int = config.MaxPlayers
         self.MaxConnections: int = config.MaxConnections
+        self.Backlog: int = config.Backlog
+        self.ConnectRate: float = config.ConnectRate
+        self.ConnectBurst: int = config.ConnectBurst
+        self.Admission = admission.AdmissionController(self.MaxPlayers, self.MaxConnections, self.ConnectRate, self.ConnectBurst)
         self.Anticheat: bool = config.Anticheat
+        self.Cheats = anticheat.Anticheat(
+            prefixes = config.AnticheatPrefixes,
+            names = config.AnticheatSprites,
+            cache_size = config.AnticheatCacheSize,
+            max_jump = config.AnticheatMaxJump,
+            room_changes = config.AnticheatRoomChanges,
+            kick_after = config.AnticheatKick
+        )
+        self.Engine: str = config.Engine
+        self.RoomIndex: bool = config.RoomIndex
+        self.CullRadius: float = config.CullRadius
+        self.DeltaUpdates: bool = config.DeltaUpdates
+        self.DeltaKeyframe: int = config.DeltaKeyframe
+        self.BinaryProtocol: bool = config.BinaryProtocol
+        self.MaxFrameSize: int = config.MaxFrameSize
+        self.TickRate: int = config.TickRate
+        self.MaxQueue: int = config.MaxQueue
+        self.StateRate: float = config.StateRate
+        self.StateBurst: int = config.StateBurst
+        self.ChatRate: float = config.ChatRate
+        self.ChatBurst: int = config.ChatBurst
+        self.CommandRate: float = config.CommandRate
+        self.CommandBurst: int = config.CommandBurst
+        self.RateKick: int = config.RateKick
+        self.QueueBatch: int = config.QueueBatch
+        self.SendBuffer: int = config.SendBuffer
+        self.SendTimeout: float = config.SendTimeout
+        self.MetricsPort: int = config.MetricsPort
+        self.Metrics = metrics.Metrics(self, config.Metrics, config.MetricsSample)
+        self.SlowLoop: float = config.SlowLoop
+        self.Profiling = profiling.Profiling(self, config.ProfileDirectory, config.SlowLoop)
 
         self.Commands: list[PTCommand.Command] = []
+        # Clients and Lobbies are copy-on-write: replaced under ClientMutex, read without it
         self.Clients: dict[int, client.Client] = {}
-        self.ClientMutex = threading.Lock()
+        self.ClientMutex = self.Metrics.lock("ClientMutex")
+        self.Lobbies: dict[str, Lobby] = {}
+        # Case-folded name to client, changed under ClientMutex
+        self.Names: dict[str, client.Client] = {}
+        self.ChatIds = chat.MessageIds()
+        self.IdDigits: int = config.IdDigits
+        self.IdReuseDelay: float = config.IdReuseDelay
+        self.Ids = PTUtils.IdAllocator(self.IdDigits, self.IdReuseDelay)
+        self.Timers = timeouts.IdleTimers(self.Timeout, self.LoginTimeout, self.PausedTimeout)
+        self.World = world.WorldState(self, 1 / (self.TickRate or 60))
+        self.Scheduler = scheduler.TickScheduler(self, self.TickRate) if self.TickRate > 0 else None
 
         self.Keys = config.Keys
         self.Bans = config.Bans
         self.BadWords = config.BadWords
+        self.FilterIgnoreCase: bool = config.FilterIgnoreCase
+        self.FilterLeetspeak: bool = config.FilterLeetspeak
+        self.Filter = PTUtils.WordFilter(self.BadWords, self.FilterIgnoreCase, self.FilterLeetspeak)
+
+        # With several shards this process is either the front (Shard None) or one shard, linked to the front by Cluster
+        self.Shards: int = config.Shards
+        self.Shard: int | None = None
+        self.Cluster: shards.ShardLink | None = None
 
         self.Admins = []
         self.AdminPath = "admins.json"
@@ -50,6 +119,22 @@ class Server:
                     print(f"Failed to load plugin {name}: {e}")
                     continue
 
+    def load_bad_words(self, path: str):
+        """ Adds the words in the specified file (one per line) to the bad word list. """
+        try:
+            with open(path, "r") as f:
+                words = [line.strip() for line in f]
+        except Exception as e:
+            print(f"Failed to load bad words from {path}: {e}")
+            return
+
+        self.set_bad_words(self.BadWords + [word for word in words if word and word not in self.BadWords])
+
+    def set_bad_words(self, words: list[str]):
+        """ Replaces the bad word list and recompiles the filter. """
+        self.BadWords = words
+        self.Filter = PTUtils.WordFilter(words, self.FilterIgnoreCase, self.FilterLeetspeak)
+
     def load_admins(self, admin_path: str = None):
         """ Loads admins from the specified file. """
         if admin_path is not None:
@@ -93,17 +178,14 @@ class Server:
             if not self.Up:
                 return
 
-            to_remove = []
-            with self.ClientMutex:
-                for _, client in self.Clients.items():
-                    if time.time() - client.LastMessage > self.Timeout:
-                        to_remove.append(client.ID)
+            self.expire_clients()
 
-            for id in to_remove:
-                client = self.Clients[id]
+    def expire_clients(self):
+        """ Closes every client that has not sent anything within its timeout. """
+        for client in self.Timers.expire():
+            if client.Active:
                 client.close(MessageType.OmsgDisconnect, "Timed out")
 
-
     def start(self):
         print(f"Starting server on {self.Host}:{self.Port}...")
 
@@ -124,14 +206,31 @@ class Server:
 
         self.Up = True
 
+        if self.Shards > 1:
+            shards.serve(self)
+            return
+
+        if self.MetricsPort > 0:
+            self.Metrics.serve_http("127.0.0.1", self.MetricsPort)
+
+        if self.SlowLoop > 0:
+            threading.Thread(target=self.Profiling.watch, daemon=True).start()
+
+        if self.Engine == "asyncio":
+            asyncio.run(aio.serve(self))
+            return
+
         threading.Thread(target=self.check_connections).start()
 
+        if self.Scheduler is not None:
+            threading.Thread(target=self.Scheduler.run).start()
+
         # Create TCP Listner
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         try:
             sock.bind((self.Host, self.Port))
-            sock.listen(1)
+            sock.listen(self.Backlog)
         except Exception as e:
             print(f"Failed to bind to {self.Host}:{self.Port}: {e}")
             self.Up = False
@@ -143,13 +242,28 @@ class Server:
         while self.Up:
             try:
                 conn, addr = sock.accept()
+                ip256 = PTUtils.sha256(addr[0])
+
+                reason = self.Admission.admit(ip256)
+                if reason is not None:
+                    self.refuse(conn, reason)
+                    continue
+
+                try:
+                    id = self.Ids.allocate()
+                except RuntimeError as e:
+                    self.Admission.cancel(ip256)
+                    self.refuse(conn, "The server is full.")
+                    print(f"Failed to accept connection: {e}")
+                    continue
 
                 c = client.Client(
-                    id = PTUtils.generate_unique_id(self.Clients),
-                    conn = conn,
-                    ip256 = PTUtils.sha256(addr[0]),
+                    id = id,
+                    conn = connection.SocketConnection(conn),
+                    ip256 = ip256,
                     server = self
                 )
+                c.Admitted = True
 
                 threading.Thread(target=c.accept).start() 
                 
@@ -161,46 +275,67 @@ class Server:
     def stop(self):
         self.Up = False
 
-        with self.ClientMutex:
-            for _, client in self.Clients.items():
-                client.close(MessageType.OmsgDisconnect, "Server shutting down")
+        for client in list(self.Clients.values()):
+            client.close(MessageType.OmsgDisconnect, "Server shutting down")
+
+    def refuse(self, conn: socket.socket, reason: str):
+        """ Kicks a connection that was never admitted, without creating a client for it. """
+        try:
+            conn.sendall(json.dumps(CompactMessage(MessageType.OmsgKick.value, reason).to_json()).encode())
+        except Exception:
+            pass
+
+        conn.close()
 
     def broadcast(self, msg: str, lobby: str = None):
-        with self.ClientMutex:
-            for _, client in self.Clients.items():
-                if lobby is None or client.Lobby == lobby:
-                    client.append(CompactMessage(MessageType.OmsgDefault, msg))
+        if lobby is not None:
+            for client in self.lobby_members(lobby):
+                client.append(CompactMessage(MessageType.OmsgDefault, msg))
+            return
+
+        for _, client in self.Clients.items():
+            client.append(CompactMessage(MessageType.OmsgDefault, msg))
 
     def announce(self, msg: str):
-        with self.ClientMutex:
-            for _, client in self.Clients.items():
-                client.append(CompactMessage(MessageType.OmsgAnnouncement, msg))
+        self.announce_local(msg)
+
+        if self.Cluster is not None:
+            self.Cluster.send("announce", msg)
+
+    def announce_local(self, msg: str):
+        """ Announces to the clients of this process only. """
+        for _, client in self.Clients.items():
+            client.append(CompactMessage(MessageType.OmsgAnnouncement, msg))
 
     def kick(self, id: int, reason: str):
-        with self.ClientMutex:
-            if id in self.Clients:
-                client = self.Clients[id]
-            else:
-                return
-            
+        client = self.Clients.get(id, None)
+        if client is None:
+            # The ID may belong to a client of another shard
+            if self.Cluster is not None:
+                self.Cluster.send("kick", id, reason)
+            return
+
         if client.Admin:
             return
         
         client.close(MessageType.OmsgKick, reason)
 
     def ban(self, id: int, reason: str):
-        with self.ClientMutex:
-            if id in self.Clients:
-                client = self.Clients[id]
-            else:
-                return
-            
+        client = self.Clients.get(id, None)
+        if client is None:
+            if self.Cluster is not None:
+                self.Cluster.send("ban", id, reason)
+            return
+
         if client.Admin:
             return
         
         self.Bans.append(client.Ip256)
         client.close(MessageType.OmsgKick, reason)
 
+        if self.Cluster is not None:
+            self.Cluster.send("banned", client.Ip256)
+
 
     def check_key(self, key: str):
         return key in self.Keys
@@ -209,15 +344,131 @@ class Server:
         return ip256 in self.Bans
     
     def lobby_count(self, lobby: str):
-        count = 0
+        lob = self.Lobbies.get(lobby, None)
+        return len(lob.Members) if lob is not None else 0
+
+    def lobby_members(self, lobby: str) -> list[client.Client]:
+        """ Returns the logged in clients of a lobby. """
+        lob = self.Lobbies.get(lobby, None)
+        return list(lob.Members.values()) if lob is not None else []
+
+    def lobby_chat(self, lobby: str) -> chat.ChatLog:
+        """ Returns the chat log of a lobby, empty if nobody is in it. """
+        lob = self.Lobbies.get(lobby, None)
+        return lob.Chat if lob is not None else chat.ChatLog(self.ChatIds)
+
+    def room_members(self, lobby: str, room: int) -> list[client.Client]:
+        lob = self.Lobbies.get(lobby, None)
+        return list(lob.room(room).values()) if lob is not None else []
+
+    def register(self, client: client.Client):
+        with self.ClientMutex:
+            clients = dict(self.Clients)
+            clients[client.ID] = client
+            self.Clients = clients
+
+        self.Timers.add(client)
 
+    def unregister(self, client: client.Client):
         with self.ClientMutex:
-            for _, client in self.Clients.items():
-                if client.Lobby == lobby:
-                    count += 1
+            if client.ID not in self.Clients:
+                return
+
+            clients = dict(self.Clients)
+            del clients[client.ID]
+            self.Clients = clients
+
+            # Only the call that actually removed the client gets here, so its traffic is counted once
+            self.Metrics.retire(client)
+
+        self.Timers.remove(client)
+
+    def find_name(self, name: str) -> client.Client | None:
+        return self.Names.get(name.casefold(), None)
+
+    def claim_name(self, client: client.Client, name: str, takeover: bool = False) -> tuple[str, client.Client | None]:
+        """
+        Gives the client a unique name, releasing its old one.
+        If the name is taken, either a suffix is added or (with takeover) the holder is returned to be closed.
+        """
+        with self.ClientMutex:
+            holder = self.Names.get(name.casefold(), None)
+            displaced = None
+
+            if holder is not None and holder is not client:
+                if takeover:
+                    displaced = holder
+                else:
+                    name = self._free_name(name, client.ID)
+
+            if self.Names.get(client.Name.casefold(), None) is client:
+                del self.Names[client.Name.casefold()]
 
+            self.Names[name.casefold()] = client
+            client.Name = name
+
+        return name, displaced
+
+    def release_name(self, client: client.Client):
+        with self.ClientMutex:
+            if self.Names.get(client.Name.casefold(), None) is client:
+                del self.Names[client.Name.casefold()]
+
+    def _free_name(self, name: str, id: int) -> str:
+        # A few random digits almost always work, so only fall back to counting when the server is crowded
+        for digits in range(1, 4):
+            for _ in range(4):
+                candidate = name + str(random.randint(0, 10 ** digits - 1)).zfill(digits)
+                if candidate.casefold() not in self.Names:
+                    return candidate
+
+        candidate = f"{name}{id}"
+        suffix = 0
+
+        while candidate.casefold() in self.Names:
+            suffix += 1
+            candidate = f"{name}{id}-{suffix}"
+
+        return candidate
+
+    def join_lobby(self, client: client.Client, lobby: str):
+        """ Moves the client into the given lobby. """
+        # Lobbies are only created and removed under ClientMutex, so one can't be removed while joining it
+        with self.ClientMutex:
+            self._leave_lobby(client)
+
+            lob = self.Lobbies.get(lobby, None)
+            if lob is None:
+                lob = Lobby(lobby, self.ChatIds)
+
+                lobbies = dict(self.Lobbies)
+                lobbies[lobby] = lob
+                self.Lobbies = lobbies
+
+            client.Lobby = lobby
+            client.Chat.join(lob.Chat)
+            lob.add(client)
+
+    def leave_lobby(self, client: client.Client):
+        """ Removes the client from its lobby. """
+        with self.ClientMutex:
+            self._leave_lobby(client)
+
+    def move_room(self, client: client.Client, room: int):
+        """ Moves a logged in client to another room of its lobby. """
+        lob = self.Lobbies.get(client.Lobby, None)
+        if lob is not None:
+            lob.move(client, room)
+
+    def _leave_lobby(self, client: client.Client):
+        lob = self.Lobbies.get(client.Lobby, None)
+        if lob is None or not lob.remove(client):
+            return
 
-        return count
+        if len(lob.Members) == 0:
+            lobbies = dict(self.Lobbies)
+            del lobbies[lob.Name]
+            self.Lobbies = lobbies
     
     def register_command(self, command: PTCommand.Command):
         self.Commands.append(command)
\ No newline at end of file
@@ -0,0 +1,366 @@
+from __future__ import annotations
+
+import itertools
+import multiprocessing
+import socket
+import threading
+import zlib
+
+from dataclasses import dataclass
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+
+import PTUtils
+
+from . import client
+from . import connection
+from . import server
+from .messages import Message, MessageType
+from .stream import JsonStream
+
+# Messages a shard sends to every other shard, and ones meant for the shard owning the client ID in their first field
+BROADCAST = ("announce", "banned")
+ROUTED = ("kick", "ban")
+
+class ShardLink:
+    """ A worker's end of the pipe to the front process, used for connections handed over and cross-shard commands. """
+    def __init__(self, srv: server.Server, pipe: Connection):
+        self.ConnectedServer: server.Server = srv
+        self.Pipe: Connection = pipe
+        self.SendMutex: threading.Lock = threading.Lock()
+
+    def send(self, *msg):
+        try:
+            with self.SendMutex:
+                self.Pipe.send(msg)
+        except OSError:
+            # The front process is gone, the shard is shutting down anyway
+            pass
+
+    def run(self):
+        """ Handles messages from the front process until the pipe closes. """
+        srv = self.ConnectedServer
+
+        while srv.Up:
+            try:
+                msg = self.Pipe.recv()
+            except (EOFError, OSError):
+                break
+
+            match msg:
+                case ("conn", ip256, data):
+                    fd = reduction.recv_handle(self.Pipe)
+                    self.adopt(socket.socket(fileno=fd), ip256, data)
+
+                case ("announce", text):
+                    srv.announce_local(text)
+
+                case ("kick", id, reason):
+                    if id in srv.Clients:
+                        srv.kick(id, reason)
+
+                case ("ban", id, reason):
+                    if id in srv.Clients:
+                        srv.ban(id, reason)
+
+                case ("banned", ip256):
+                    if ip256 not in srv.Bans:
+                        srv.Bans.append(ip256)
+
+                case ("pm", request, sender, username, name, body):
+                    target = srv.find_name(name)
+
+                    if target is not None:
+                        target.pm(Message(Body = body, Username = username, Id = sender))
+
+                    self.send("pm_result", request, target is not None)
+
+                case ("pm_sent", sender, name, body):
+                    c = srv.Clients.get(sender, None)
+
+                    if c is not None:
+                        c.pm(Message(Body = body, Username = "You -> " + name, Id = sender))
+
+                case ("pm_missing", sender, name):
+                    c = srv.Clients.get(sender, None)
+
+                    if c is not None:
+                        c.server_pm(f"User '{name}' not found.")
+
+        srv.stop()
+
+    def adopt(self, conn: socket.socket, ip256: str, data: bytes):
+        """ Takes over a connection the front process already read the login from. """
+        conn.setblocking(True)
+
+        try:
+            id = self.ConnectedServer.Ids.allocate()
+        except RuntimeError as e:
+            print(f"Failed to accept connection: {e}")
+            self.ConnectedServer.refuse(conn, "The server is full.")
+            self.send("release", ip256)
+            return
+
+        c = client.Client(
+            id = id,
+            conn = connection.SocketConnection(conn),
+            ip256 = ip256,
+            server = self.ConnectedServer
+        )
+        c.Admitted = True
+
+        def run():
+            c.admit()
+
+            if c.receive(data):
+                c.loop()
+
+        threading.Thread(target=run).start()
+
+class RemoteAdmission:
+    """ Stands in for the AdmissionController inside a shard, slots are owned by the front process. """
+    def __init__(self, link: ShardLink):
+        self.Link: ShardLink = link
+        self.Mutex: threading.Lock = threading.Lock()
+
+    def release(self, c: client.Client):
+        with self.Mutex:
+            if not c.Admitted:
+                return
+
+            c.Admitted = False
+
+        self.Link.send("release", c.Ip256)
+
+@dataclass(slots=True)
+class PrivateMessage:
+    Shard: int
+    Sender: int
+    Username: str
+    Name: str
+    Body: str
+    Candidates: list[int]
+    Asked: int = -1
+
+def worker(srv: server.Server, shard: int, pipe: Connection, inherited: list[Connection]):
+    """ Runs one shard on the server state inherited from the front process. """
+    # Holding on to the front's ends would keep the pipe open after the front exits
+    for other in inherited:
+        other.close()
+
+    link = ShardLink(srv, pipe)
+
+    srv.Shard = shard
+    srv.Cluster = link
+    srv.Admission = RemoteAdmission(link)
+    srv.Ids = PTUtils.IdAllocator(srv.IdDigits, srv.IdReuseDelay, shard, srv.Shards)
+
+    if srv.MetricsPort > 0:
+        srv.Metrics.serve_http("127.0.0.1", srv.MetricsPort + 1 + shard)
+
+    if srv.SlowLoop > 0:
+        threading.Thread(target=srv.Profiling.watch, daemon=True).start()
+
+    threading.Thread(target=srv.check_connections, daemon=True).start()
+
+    if srv.Scheduler is not None:
+        threading.Thread(target=srv.Scheduler.run, daemon=True).start()
+
+    link.run()
+
+class Front:
+    """ Accepts connections, reads the login to find the lobby and hands the socket to the shard that owns it. """
+    def __init__(self, srv: server.Server):
+        self.ConnectedServer: server.Server = srv
+        self.Pipes: list[Connection] = []
+        self.PipeMutexes: list[threading.Lock] = []
+        self.Workers: list[multiprocessing.Process] = []
+
+        # Private messages to names the sender's shard doesn't have, asked of one shard at a time so only one player gets them
+        self.Messages: dict[int, PrivateMessage] = {}
+        self.MessageIds: itertools.count = itertools.count(1)
+        self.MessageMutex: threading.Lock = threading.Lock()
+
+    def start_workers(self):
+        # Forked, so every shard starts with the plugins, bad words and admins already loaded here
+        context = multiprocessing.get_context("fork")
+
+        for shard in range(self.ConnectedServer.Shards):
+            ours, theirs = context.Pipe()
+            process = context.Process(target=worker, args=(self.ConnectedServer, shard, theirs, self.Pipes + [ours]), daemon=True)
+            process.start()
+            theirs.close()
+
+            self.Pipes.append(ours)
+            self.PipeMutexes.append(threading.Lock())
+            self.Workers.append(process)
+
+        for shard in range(len(self.Pipes)):
+            threading.Thread(target=self.relay, args=(shard,), daemon=True).start()
+
+    def shard_of(self, lobby: str) -> int:
+        # A stable hash, so a lobby always lands on the same shard
+        return zlib.crc32(lobby.encode()) % len(self.Pipes)
+
+    def send(self, shard: int, *msg):
+        with self.PipeMutexes[shard]:
+            self.Pipes[shard].send(msg)
+
+    def relay(self, shard: int):
+        """ Forwards cross-shard messages from one shard and frees the slots of its closed clients. """
+        pipe = self.Pipes[shard]
+
+        while self.ConnectedServer.Up:
+            try:
+                msg = pipe.recv()
+            except (EOFError, OSError):
+                print(f"Shard {shard} stopped")
+                self.skip_shard(shard)
+                return
+
+            if msg[0] == "release":
+                self.ConnectedServer.Admission.cancel(msg[1])
+            elif msg[0] == "pm":
+                self.private_message(shard, *msg[1:])
+            elif msg[0] == "pm_result":
+                self.private_message_result(*msg[1:])
+            elif msg[0] in BROADCAST:
+                for other in range(len(self.Pipes)):
+                    if other != shard:
+                        self.send(other, *msg)
+            elif msg[0] in ROUTED:
+                self.send(msg[1] % len(self.Pipes), *msg)
+
+    def private_message(self, shard: int, sender: int, username: str, name: str, body: str):
+        others = [other for other in range(len(self.Pipes)) if other != shard]
+
+        with self.MessageMutex:
+            request = next(self.MessageIds)
+            self.Messages[request] = PrivateMessage(shard, sender, username, name, body, others)
+
+        self.ask_next(request)
+
+    def private_message_result(self, request: int, delivered: bool):
+        with self.MessageMutex:
+            pm = self.Messages.get(request, None)
+
+            if pm is not None and delivered:
+                del self.Messages[request]
+
+        if pm is None:
+            return
+
+        if delivered:
+            self.send(pm.Shard, "pm_sent", pm.Sender, pm.Name, pm.Body)
+        else:
+            self.ask_next(request)
+
+    def skip_shard(self, shard: int):
+        """ Moves messages waiting on a stopped shard's answer on to the next one. """
+        with self.MessageMutex:
+            waiting = [request for request, pm in self.Messages.items() if pm.Asked == shard]
+
+        for request in waiting:
+            self.ask_next(request)
+
+    def ask_next(self, request: int):
+        """ Asks the next shard that may have the name to deliver the message, or tells the sender nobody has it. """
+        while True:
+            with self.MessageMutex:
+                pm = self.Messages[request]
+
+                if len(pm.Candidates) == 0:
+                    del self.Messages[request]
+                    break
+
+                shard = pm.Candidates.pop(0)
+                pm.Asked = shard
+
+            try:
+                self.send(shard, "pm", request, pm.Sender, pm.Username, pm.Name, pm.Body)
+                return
+            except OSError:
+                # That shard is gone, try the next one
+                continue
+
+        self.send(pm.Shard, "pm_missing", pm.Sender, pm.Name)
+
+    def hand_over(self, conn: socket.socket, ip256: str):
+        """ Waits for the login packet, then passes the socket and everything read so far to its shard. """
+        srv = self.ConnectedServer
+        stream = JsonStream(srv.MaxFrameSize)
+        data = b""
+        lobby = None
+
+        try:
+            conn.settimeout(srv.LoginTimeout or srv.Timeout)
+
+            while lobby is None:
+                raw = conn.recv(2048)
+                if not raw:
+                    raise ConnectionResetError("No data received.")
+
+                data += raw
+
+                # Stops at the login, anything after it may already be binary frames, which the shard replays from data
+                for packet in stream.feed(raw, is_login):
+                    if is_login(packet):
+                        lobby = packet.get("lobby", "")
+        except Exception as e:
+            print(f"Connection closed before logging in: {e}")
+            srv.Admission.cancel(ip256)
+            conn.close()
+            return
+
+        shard = self.shard_of(lobby if isinstance(lobby, str) else "")
+
+        try:
+            with self.PipeMutexes[shard]:
+                self.Pipes[shard].send(("conn", ip256, data))
+                reduction.send_handle(self.Pipes[shard], conn.fileno(), self.Workers[shard].pid)
+        except Exception as e:
+            print(f"Failed to hand connection to shard {shard}: {e}")
+            srv.Admission.cancel(ip256)
+
+        # The shard has its own copy of the socket now
+        conn.close()
+
+def is_login(packet: dict) -> bool:
+    return packet.get("type", None) == MessageType.ImsgLogin.value
+
+def serve(srv: server.Server):
+    """ Runs the front process: accepting, admission and routing, while the shards run the game. """
+    front = Front(srv)
+    front.start_workers()
+
+    # Started after forking, so the shards don't inherit the listener, they serve on the ports after it
+    if srv.MetricsPort > 0:
+        srv.Metrics.serve_http("127.0.0.1", srv.MetricsPort)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    try:
+        sock.bind((srv.Host, srv.Port))
+        sock.listen(srv.Backlog)
+    except Exception as e:
+        print(f"Failed to bind to {srv.Host}:{srv.Port}: {e}")
+        srv.Up = False
+        return
+
+    print(f"Server started on {srv.Host}:{srv.Port} ({srv.Shards} shards)")
+
+    while srv.Up:
+        try:
+            conn, addr = sock.accept()
+            ip256 = PTUtils.sha256(addr[0])
+
+            reason = srv.Admission.admit(ip256)
+            if reason is not None:
+                srv.refuse(conn, reason)
+                continue
+
+            threading.Thread(target=front.hand_over, args=(conn, ip256), daemon=True).start()
+
+        except Exception as e:
+            print(f"Failed to accept connection: {e}")
+            continue
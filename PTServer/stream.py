@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import collections.abc
+import json
+
+class FrameError(Exception):
+    pass
+
+class JsonStream:
+    """ Incremental decoder for newline separated JSON packets that may be split across recv calls. """
+    def __init__(self, max_frame: int = 4096):
+        self.MaxFrame: int = max_frame
+        self.Buffer: bytes = b""
+
+    def feed(self, data: bytes, stop: collections.abc.Callable[[dict], bool] | None = None) -> list[dict]:
+        """
+        Returns every complete packet in the buffered data, keeping a trailing partial one for later.
+        Parsing ends after a packet stop returns True for, the bytes after it are left unparsed in Buffer.
+        """
+        if self.Buffer:
+            data = self.Buffer + data
+            self.Buffer = b""
+
+        packets = []
+        start = 0
+
+        while True:
+            # A packet that switches protocols may be followed by binary frames without a newline, and those can contain newlines
+            # of their own, so it has to be found before the data is split into lines
+            if stop is not None:
+                packet, end = leading(data, start)
+
+                if packet is not None:
+                    packets.append(packet)
+                    start = end
+
+                    if stop(packet):
+                        # e.g. a login that switches to the binary protocol, what follows isn't JSON anymore
+                        if data.startswith(b"\r\n", start):
+                            start += 2
+                        elif data.startswith(b"\n", start):
+                            start += 1
+
+                        self.Buffer = data[start:]
+                        return packets
+
+                    continue
+
+            end = data.find(b"\n", start)
+            if end < 0:
+                break
+
+            packet = loads(data[start:end])
+            start = end + 1
+
+            if packet is not None:
+                packets.append(packet)
+
+        partial = data[start:]
+
+        # Clients don't always end their last packet with a newline, so see if it's already whole
+        if partial:
+            packet = loads(partial) if partial.endswith(b"}") else None
+
+            if packet is not None:
+                packets.append(packet)
+            elif len(partial) > self.MaxFrame:
+                raise FrameError(f"Packet larger than {self.MaxFrame} bytes")
+            else:
+                self.Buffer = partial
+
+        return packets
+
+def loads(line: bytes) -> dict | None:
+    try:
+        packet = json.loads(line)
+    except ValueError:
+        return None
+
+    return packet if isinstance(packet, dict) else None
+
+DECODER = json.JSONDecoder()
+
+def leading(data: bytes, start: int = 0) -> tuple[dict | None, int]:
+    """ Decodes a JSON object at the start of data[start:], returns it and the offset right after it, or None and start if there isn't a whole one. """
+    offset = start
+    while offset < len(data) and data[offset] in b" \t\r\n":
+        offset += 1
+
+    if not data.startswith(b"{", offset):
+        return None, start
+
+    # Undecodable bytes map to lone surrogates and back, so character offsets can be turned into byte offsets again
+    text = data[offset:].decode("utf-8", "surrogateescape")
+
+    try:
+        packet, end = DECODER.raw_decode(text)
+    except ValueError:
+        return None, start
+
+    if not isinstance(packet, dict):
+        return None, start
+
+    return packet, offset + len(text[:end].encode("utf-8", "surrogateescape"))
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+
+from . import client
+
+class IdleTimers:
+    """
+    Hashed timer wheel of idle deadlines, bucketed by second on the monotonic clock.
+    Activity only updates the client's LastMessage, a client is moved to a later bucket when its old one comes due.
+    """
+    def __init__(self, timeout: float, login_timeout: float = 0, paused_timeout: float = 0):
+        self.Timeout: float = timeout
+        self.LoginTimeout: float = login_timeout or timeout
+        self.PausedTimeout: float = paused_timeout or timeout
+
+        self.Slots: dict[int, set[client.Client]] = {}
+        self.Scheduled: dict[client.Client, int] = {}
+        self.Current: int = math.floor(time.monotonic())
+        self.Mutex: threading.Lock = threading.Lock()
+
+    def timeout(self, c: client.Client) -> float:
+        """ Returns how long the client may stay silent in its current state. """
+        if not c.LoggedIn:
+            return self.LoginTimeout
+
+        return self.PausedTimeout if c.Paused else self.Timeout
+
+    def earliest(self, c: client.Client) -> float:
+        """ Returns the soonest the client could time out, it can pause and unpause between checks. """
+        if not c.LoggedIn:
+            return c.LastMessage + self.LoginTimeout
+
+        return c.LastMessage + min(self.Timeout, self.PausedTimeout)
+
+    def add(self, c: client.Client):
+        """ Schedules the client, or moves it to the bucket its current state calls for. """
+        with self.Mutex:
+            self._schedule(c, self.earliest(c))
+
+    def remove(self, c: client.Client):
+        with self.Mutex:
+            slot = self.Scheduled.pop(c, None)
+
+            if slot is not None:
+                self._discard(c, slot)
+
+    def expire(self, now: float = None) -> list[client.Client]:
+        """ Returns the clients whose deadline has passed, they're no longer scheduled. """
+        now = time.monotonic() if now is None else now
+        target = math.floor(now)
+        expired = []
+
+        with self.Mutex:
+            while self.Current <= target:
+                due = self.Slots.pop(self.Current, None)
+                self.Current += 1
+
+                if due is None:
+                    continue
+
+                for c in due:
+                    del self.Scheduled[c]
+
+                    if now - c.LastMessage > self.timeout(c):
+                        expired.append(c)
+                        continue
+
+                    deadline = self.earliest(c)
+
+                    # Past the earliest deadline but still within the one for its state, e.g. a paused client
+                    if deadline <= now:
+                        deadline = c.LastMessage + self.timeout(c)
+
+                    self._schedule(c, deadline)
+
+        return expired
+
+    def __len__(self) -> int:
+        return len(self.Scheduled)
+
+    def _schedule(self, c: client.Client, deadline: float):
+        # Rounded up so a client is never checked before its deadline, and never into a bucket that was already handled
+        slot = max(math.ceil(deadline), self.Current)
+        old = self.Scheduled.get(c, None)
+
+        if old == slot:
+            return
+
+        if old is not None:
+            self._discard(c, old)
+
+        self.Scheduled[c] = slot
+
+        if slot not in self.Slots:
+            self.Slots[slot] = set()
+
+        self.Slots[slot].add(c)
+
+    def _discard(self, c: client.Client, slot: int):
+        bucket = self.Slots.get(slot, None)
+
+        if bucket is None:
+            return
+
+        bucket.discard(c)
+
+        if len(bucket) == 0:
+            del self.Slots[slot]
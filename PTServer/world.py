@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import json
+import math
+import threading
+import time
+
+from . import client
+from . import server
+from .messages import CompactClient
+
+class RoomSnapshot:
+    """ Pre-serialized entries of one (lobby, room), optionally bucketed into a grid for culling. """
+    def __init__(self, entries: list[tuple[int, float, float, str, dict]], cell: float = 0):
+        self.BuiltAt: float = time.time()
+        self.Entries: list[tuple[int, float, float, str, dict]] = entries
+        self.Cell: float = cell
+        self.Cells: dict[tuple[int, int], list[tuple[int, float, float, str, dict]]] = {}
+
+        if cell > 0:
+            for entry in entries:
+                key = (int(entry[1] // cell), int(entry[2] // cell))
+
+                if key not in self.Cells:
+                    self.Cells[key] = []
+
+                self.Cells[key].append(entry)
+
+    def visible(self, viewer: int, x: float, y: float) -> list[tuple[int, float, float, str, dict]]:
+        """ Returns the entries visible to the viewer, everything in the room if culling is off. """
+        if self.Cell <= 0:
+            return [entry for entry in self.Entries if entry[0] != viewer]
+
+        radius = self.Cell * self.Cell
+        cx, cy = int(x // self.Cell), int(y // self.Cell)
+        entries = []
+
+        for gx in (cx - 1, cx, cx + 1):
+            for gy in (cy - 1, cy, cy + 1):
+                for entry in self.Cells.get((gx, gy), ()):
+                    if entry[0] != viewer and (entry[1] - x) ** 2 + (entry[2] - y) ** 2 <= radius:
+                        entries.append(entry)
+
+        return entries
+
+class WorldState:
+    """ Pre-serialized player lists for every (lobby, room), built at most once per tick and shared by all clients. """
+    def __init__(self, server: server.Server, interval: float):
+        self.ConnectedServer: server.Server = server
+        self.Interval: float = interval
+
+        self.Rooms: dict[tuple[str, int], RoomSnapshot] = {}
+        self.BuiltAt: float = 0
+        self.BuildMutex: threading.Lock = threading.Lock()
+
+    def build(self):
+        """ Serializes every client once and groups them by lobby and room. """
+        start = time.perf_counter()
+        rooms: dict[tuple[str, int], list[tuple[int, float, float, str, dict]]] = {}
+
+        # The registry is copy-on-write, so none of this needs the client lock
+        if self.ConnectedServer.RoomIndex:
+            for name, lobby in self.ConnectedServer.Lobbies.items():
+                for room, members in lobby.Rooms.items():
+                    rooms[(name, room)] = [entry(c) for c in members.values()]
+        else:
+            for _, c in self.ConnectedServer.Clients.items():
+                key = (c.Lobby, c.Data.Room)
+
+                if key not in rooms:
+                    rooms[key] = []
+
+                rooms[key].append(entry(c))
+
+        cull = self.ConnectedServer.CullRadius
+        self.Rooms = {key: RoomSnapshot(entries, cull) for key, entries in rooms.items()}
+        self.BuiltAt = time.time()
+        self.ConnectedServer.Metrics.Phases["build"].observe(time.perf_counter() - start)
+
+    def build_room(self, lobby: str, room: int) -> RoomSnapshot:
+        """ Serializes only the members of one room, read from the server's room index. """
+        start = time.perf_counter()
+        entries = [entry(c) for c in self.ConnectedServer.room_members(lobby, room)]
+
+        snapshot = RoomSnapshot(entries, self.ConnectedServer.CullRadius)
+
+        # Don't keep snapshots of rooms that have emptied out
+        if len(entries) > 0:
+            self.Rooms[(lobby, room)] = snapshot
+        else:
+            self.Rooms.pop((lobby, room), None)
+
+        self.ConnectedServer.Metrics.Phases["build"].observe(time.perf_counter() - start)
+        return snapshot
+
+    def room(self, lobby: str, room: int) -> RoomSnapshot:
+        """ Returns the snapshot of a room, rebuilding it if the tick has passed. """
+        if not self.ConnectedServer.RoomIndex:
+            if time.time() - self.BuiltAt > self.Interval:
+                start = time.perf_counter()
+
+                with self.BuildMutex:
+                    # Another client may have rebuilt it while we were waiting
+                    if time.time() - self.BuiltAt > self.Interval:
+                        self.build()
+
+                self.ConnectedServer.Metrics.building(time.perf_counter() - start)
+
+            return self.Rooms.get((lobby, room), EMPTY)
+
+        snapshot = self.Rooms.get((lobby, room), None)
+
+        if snapshot is None or time.time() - snapshot.BuiltAt > self.Interval:
+            start = time.perf_counter()
+
+            with self.BuildMutex:
+                snapshot = self.Rooms.get((lobby, room), None)
+
+                if snapshot is None or time.time() - snapshot.BuiltAt > self.Interval:
+                    snapshot = self.build_room(lobby, room)
+
+            self.ConnectedServer.Metrics.building(time.perf_counter() - start)
+
+        return snapshot
+
+    def visible(self, c: client.Client) -> str:
+        """ Returns the JSON array of every other client the given client can see. """
+        x, y = position(c)
+        entries = self.room(c.Lobby, c.Data.Room).visible(c.ID, x, y)
+
+        return "[" + ", ".join(entry[3] for entry in entries) + "]"
+
+    def visible_states(self, c: client.Client) -> dict[int, dict]:
+        """ Returns the state of every other client the given client can see, by ID. """
+        x, y = position(c)
+        entries = self.room(c.Lobby, c.Data.Room).visible(c.ID, x, y)
+
+        return {entry[0]: entry[4] for entry in entries}
+
+EMPTY = RoomSnapshot([])
+
+def position(c: client.Client) -> tuple[float, float]:
+    # Positions come straight from the client, so don't trust them to be numbers
+    try:
+        x, y = float(c.Data.X), float(c.Data.Y)
+    except (TypeError, ValueError):
+        return 0.0, 0.0
+
+    if not math.isfinite(x) or not math.isfinite(y):
+        return 0.0, 0.0
+
+    return x, y
+
+def entry(c: client.Client) -> tuple[int, float, float, str, dict]:
+    """ Returns the client's cached entry, serializing it again only if it changed since. """
+    # Cleared before reading the state, so a change made while serializing marks it dirty again
+    if c.Dirty or c.Entry is None:
+        c.Dirty = False
+
+        x, y = position(c)
+        state = compact(c).to_json()
+        c.Entry = (c.ID, x, y, json.dumps(state), state)
+
+    return c.Entry
+
+def compact(c: client.Client) -> CompactClient:
+    return CompactClient(
+        ID = c.ID,
+        X = c.Data.X,
+        Y = c.Data.Y,
+        Name = c.Name,
+        Admin = c.Admin,
+        Room = c.Data.Room,
+        Sprite = c.Data.Sprite,
+        Frame = c.Data.Frame,
+        Dir = c.Data.Dir,
+        Palette = c.Data.Palette,
+        PaletteSprite = c.Data.PaletteSprite,
+        PaletteTexture = c.Data.PaletteTexture,
+        Color = c.Data.Color
+    )
@@ -1,15 +1,23 @@
 from __future__ import annotations
 
+import asyncio
+import collections
+import functools
 import hashlib
 import random
+import re
 import string
+import threading
 import time
 
-import PTServer
-
 VALID_NAME_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-!@#$%^&*()+=[]{}~ "
 BAD_WORDS = ["fart"]
 
+# Sprites a player is allowed to use, anything else is replaced with DEFAULT_SPRITE
+SPRITE_PREFIXES = ("spr_player", "spr_knight", "spr_shotgun", "spr_ratmount", "spr_lone")
+SPRITE_NAMES = frozenset(("spr_noise_vulnerable2", "spr_noise_crusherfall"))
+DEFAULT_SPRITE = "spr_player_idle"
+
 def sha256(str: str):
     return hashlib.sha256(str.encode()).hexdigest()
 
@@ -17,24 +25,82 @@ def keygen_alphanumeric(len: int):
     return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(len))
 
 def anticheat(sprite: str):
-    if not sprite.startswith("spr_player") and not sprite.startswith("spr_knight") and not sprite.startswith("spr_shotgun") and not sprite.startswith("spr_ratmount") and not sprite.startswith("spr_lone") and sprite != "spr_noise_vulnerable2" and sprite != "spr_noise_crusherfall":
-        sprite = "spr_player_idle"
+    if not isinstance(sprite, str) or (not sprite.startswith(SPRITE_PREFIXES) and sprite not in SPRITE_NAMES):
+        sprite = DEFAULT_SPRITE
 
     return sprite
 
-def clean(msg: str, length: int = 256, bad_words: list[str] = BAD_WORDS):
+# Leetspeak characters mapped one to one onto the letters they stand for, so match positions line up
+LEETSPEAK = str.maketrans("013457@$!|", "oieastasil")
+
+class WordFilter:
+    """ Strips disallowed characters and masks bad words, compiled once per word list. """
+    def __init__(self, words: list[str], ignore_case: bool = False, leetspeak: bool = False):
+        self.Words: tuple[str] = tuple(words)
+        self.IgnoreCase: bool = ignore_case
+        self.Leetspeak: bool = leetspeak
+
+        self.Invalid: re.Pattern = re.compile("[^" + re.escape(VALID_NAME_CHARS) + "]+")
+
+        words = [self.normalize(word) for word in words if word]
+        # Longest first, so a word is masked whole rather than just a shorter word inside it
+        words = sorted(set(words), key=len, reverse=True)
+
+        self.Pattern: re.Pattern | None = None
+        if len(words) > 0:
+            self.Pattern = re.compile("|".join(re.escape(word) for word in words))
+
+    def normalize(self, msg: str) -> str:
+        # Only ever maps one character to one character, so positions in the result match the original
+        if self.IgnoreCase:
+            msg = msg.lower()
+
+        if self.Leetspeak:
+            msg = msg.translate(LEETSPEAK)
+
+        return msg
+
+    def strip(self, msg: str) -> str:
+        return self.Invalid.sub("", msg)
+
+    def mask(self, msg: str) -> str:
+        """ Replaces bad words with asterisks, call after strip so normalizing keeps the length. """
+        if self.Pattern is None:
+            return msg
+
+        if not self.IgnoreCase and not self.Leetspeak:
+            return self.Pattern.sub(lambda match: "*" * len(match.group()), msg)
+
+        # Match against the normalized text, but mask the original
+        out = []
+        last = 0
+
+        for match in self.Pattern.finditer(self.normalize(msg)):
+            start, end = match.span()
+            out.append(msg[last:start])
+            out.append("*" * (end - start))
+            last = end
+
+        out.append(msg[last:])
+        return "".join(out)
+
+@functools.lru_cache(maxsize=16)
+def word_filter(words: tuple[str]) -> WordFilter:
+    return WordFilter(list(words))
+
+def clean(msg: str, length: int = 256, bad_words: list[str] | WordFilter = BAD_WORDS):
+    if not isinstance(bad_words, WordFilter):
+        bad_words = word_filter(tuple(bad_words))
+
     msg = msg.strip()
-    msg = ''.join(c for c in msg if c in VALID_NAME_CHARS)
+    msg = bad_words.strip(msg)
 
     if len(msg) > length and length > 0:
         msg = msg[:length]
 
-    for word in bad_words:
-        msg = msg.replace(word, "*"*len(word))
-
-    return msg
+    return bad_words.mask(msg)
 
-def clean_name(name: str, bad_words: list[str] = BAD_WORDS):
+def clean_name(name: str, bad_words: list[str] | WordFilter = BAD_WORDS):
     name = clean(name, 16, bad_words=bad_words)
     name = name.replace(" ", "-")
 
@@ -43,14 +109,44 @@ def clean_name(name: str, bad_words: list[str] = BAD_WORDS):
 
     return name
 
-def generate_unique_id(users: dict[int, PTServer.Client], digits: int = 4):
-    id = random.randint(0, 10 ** digits)
+class IdAllocator:
+    """
+    Hands out unique IDs from a shuffled pool, holding released IDs back for a while before reuse.
+    With several shards, each one only gets the IDs where id % shards == shard.
+    """
+    def __init__(self, digits: int = 4, reuse_delay: float = 60, shard: int = 0, shards: int = 1):
+        pool = list(range(shard, 10 ** digits, shards))
+        random.shuffle(pool)
 
-    while id in users:
-        id = random.randint(0, 10 ** digits)
+        self.Free: collections.deque[int] = collections.deque(pool)
+        self.Released: collections.deque[tuple[float, int]] = collections.deque()
+        self.Used: set[int] = set()
+        self.ReuseDelay: float = reuse_delay
+        self.Mutex: threading.Lock = threading.Lock()
 
-    return id
+    def allocate(self) -> int:
+        with self.Mutex:
+            now = time.monotonic()
 
+            while len(self.Released) > 0 and now - self.Released[0][0] >= self.ReuseDelay:
+                self.Free.append(self.Released.popleft()[1])
+
+            if len(self.Free) == 0:
+                raise RuntimeError("Out of client IDs")
+
+            id = self.Free.popleft()
+            self.Used.add(id)
+
+            return id
+
+    def release(self, id: int):
+        """ Returns an ID to the pool, releasing one that isn't in use does nothing. """
+        with self.Mutex:
+            if id not in self.Used:
+                return
+
+            self.Used.remove(id)
+            self.Released.append((time.monotonic(), id))
 
 class Ticker:
     def __init__(self, interval: float):
@@ -66,4 +162,42 @@ class Ticker:
         else:
             time.sleep(self.Interval - timeSinceLastTick)
         
-        return True
\ No newline at end of file
+        return True
+
+    # Same as tick, but yields to the event loop instead of blocking the thread
+    async def tick_async(self):
+        timeSinceLastTick = time.time() - self.LastTick
+
+        if timeSinceLastTick > self.Interval:
+            self.LastTick = time.time()
+        else:
+            await asyncio.sleep(self.Interval - timeSinceLastTick)
+
+        return True
+
+class TokenBucket:
+    """ Allows rate events per second on average and bursts of up to burst, not thread-safe on its own. """
+    def __init__(self, rate: float, burst: float):
+        self.Rate: float = rate
+        self.Burst: float = burst
+        self.Tokens: float = burst
+        self.Updated: float = time.monotonic()
+
+    def refill(self, now: float = None) -> float:
+        now = time.monotonic() if now is None else now
+
+        self.Tokens = min(self.Burst, self.Tokens + (now - self.Updated) * self.Rate)
+        self.Updated = now
+
+        return self.Tokens
+
+    def take(self, amount: float = 1, now: float = None) -> bool:
+        """ Takes tokens if there are enough, returns False if the event should be refused. """
+        if self.refill(now) < amount:
+            return False
+
+        self.Tokens -= amount
+        return True
+
+    def full(self, now: float = None) -> bool:
+        return self.refill(now) >= self.Burst
@@ -17,6 +17,7 @@ if __name__ == '__main__':
     )
 
     server = PTServer.Server(config=config)
+    server.load_bad_words("badwords.txt")
     server.load_plugins("plugins")
     server.start()
 
@@ -0,0 +1,73 @@
+import PTServer
+import PTCommand
+
+# Longest profile that can be asked for, in seconds, so a forgotten one doesn't run forever
+MAX_DURATION = 300
+
+def duration(args: list[str], index: int, default: float) -> float | None:
+    if len(args) <= index:
+        return default
+
+    try:
+        seconds = float(args[index])
+    except ValueError:
+        return None
+
+    return seconds if 0 < seconds <= MAX_DURATION else None
+
+class Profile(PTCommand.Command):
+    Name = "profile"
+    Description = "Samples every thread's stack for a while and reports where time goes"
+    Args = ["[seconds]", "[interval_ms]"]
+    IsAdmin = True
+
+    def run(self, args: list[str], client: PTServer.Client):
+        seconds = duration(args, 0, 10)
+        interval = duration(args, 1, 5)
+
+        if seconds is None or interval is None:
+            return False, PTCommand.FailedCommand.InvalidArgs
+
+        if not self.Server.Profiling.sample(client, seconds, interval / 1000):
+            client.server_pm("A profile is already running, use /profilestop to end it.")
+            return
+
+        client.server_pm(f"Sampling for {seconds:g}s...")
+
+class ProfileClient(PTCommand.Command):
+    Name = "profileclient"
+    Description = "Runs cProfile on one client's thread for a while"
+    Args = ["<id>", "[seconds]"]
+    IsAdmin = True
+
+    def run(self, args: list[str], client: PTServer.Client):
+        seconds = duration(args, 1, 10)
+
+        if seconds is None or not args[0].isdigit():
+            return False, PTCommand.FailedCommand.InvalidArgs
+
+        target = self.Server.Clients.get(int(args[0]), None)
+        if target is None:
+            client.server_pm(f"No client with ID {args[0]}.")
+            return
+
+        if not self.Server.Profiling.profile(client, target, seconds):
+            client.server_pm("A profile is already running, use /profilestop to end it.")
+            return
+
+        client.server_pm(f"Profiling client {target.ID} for {seconds:g}s...")
+
+class ProfileStop(PTCommand.Command):
+    Name = "profilestop"
+    Description = "Ends the running profile early"
+    Args = []
+    IsAdmin = True
+
+    def run(self, args: list[str], client: PTServer.Client):
+        if not self.Server.Profiling.stop():
+            client.server_pm("No profile is running.")
+
+def setup(server: PTServer.Server):
+    server.register_command(Profile(server=server))
+    server.register_command(ProfileClient(server=server))
+    server.register_command(ProfileStop(server=server))
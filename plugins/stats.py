@@ -0,0 +1,15 @@
+import PTServer
+import PTCommand
+
+class Stats(PTCommand.Command):
+    Name = "stats"
+    Description = "Shows server metrics"
+    Args = []
+    IsAdmin = True
+
+    def run(self, args: list[str], client: PTServer.Client):
+        for line in self.Server.Metrics.summary():
+            client.server_pm(line)
+
+def setup(server: PTServer.Server):
+    server.register_command(Stats(server=server))
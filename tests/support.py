@@ -0,0 +1,36 @@
+import PTServer
+
+from PTConfig import Config
+
+class FakeConn:
+    """ Stands in for a client connection, keeping everything the server sends. """
+    def __init__(self):
+        self.Sent: bytes = b""
+
+    def send(self, data: bytes):
+        self.Sent += data
+
+    def flush(self) -> int:
+        return 0
+
+    def pending(self) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+def make_server(**overrides) -> PTServer.Server:
+    fields = {
+        "Host": "127.0.0.1", "Port": 0, "Timeout": 10, "MaxPlayers": 16, "MaxConnections": 16,
+        "Anticheat": False, "Keys": [], "Bans": [], "BadWords": []
+    }
+    fields.update(overrides)
+
+    return PTServer.Server(config = Config(**fields))
+
+def make_client(server: PTServer.Server, id: int = 1) -> PTServer.Client:
+    """ An admitted client that hasn't logged in yet. """
+    c = PTServer.Client(id = id, conn = FakeConn(), ip256 = f"ip{id}", server = server)
+    c.admit()
+
+    return c
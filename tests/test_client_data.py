@@ -0,0 +1,44 @@
+import json
+import unittest
+
+from PTServer.client import ClientData
+from PTServer.messages import MessageType
+
+from support import make_client, make_server
+
+class CoercionTest(unittest.TestCase):
+    def test_flags(self):
+        for value, expected in ((1, True), (0, False), (1.0, True), ("1", True), ("0", False), ("true", True), ("False", False), (True, True)):
+            data = ClientData.from_dict({"name": "a", "delta": value, "binary": value})
+            self.assertIs(data.Delta, expected, value)
+            self.assertIs(data.Binary, expected, value)
+
+    def test_bad_flags(self):
+        for value in (2, -1, 0.5, "yes", "", [], {}):
+            with self.assertRaises(ValueError, msg = repr(value)):
+                ClientData.from_dict({"delta": value})
+
+    def test_numbers(self):
+        data = ClientData.from_dict({"type": "2", "msgId": 3.0, "x": "1.5", "frame": 4, "ack": "7"})
+        self.assertEqual((data.Type, data.MsgId, data.X, data.Frame, data.Ack), (2, 3, 1.5, 4, 7))
+
+        for packet in ({"type": 1.5}, {"x": "nan"}, {"x": "inf"}, {"msgId": "a"}, {"name": 5}):
+            with self.assertRaises(ValueError, msg = repr(packet)):
+                ClientData.from_dict(packet)
+
+    def test_nulls_and_unknown_keys(self):
+        data = ClientData.from_dict({"name": None, "delta": None, "unknown": [1]})
+        self.assertEqual((data.Name, data.Delta), ("", False))
+
+    def test_login_with_numeric_flag(self):
+        srv = make_server()
+        c = make_client(srv)
+
+        login = {"type": MessageType.ImsgLogin.value, "name": "bob", "ver": srv.Version, "lobby": "a", "delta": 1}
+        c.receive(json.dumps(login).encode() + b"\n")
+
+        self.assertTrue(c.LoggedIn)
+        self.assertIsNotNone(c.Tracker)
+
+if __name__ == "__main__":
+    unittest.main()
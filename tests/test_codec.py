@@ -0,0 +1,182 @@
+import json
+import unittest
+
+from PTServer.codec import MAX_STRING_BYTES, MAX_STRINGS, BinaryCodec, CodecError
+from PTServer.messages import MessageType
+
+from support import make_client, make_server
+
+STATE = {
+    "type": 2, "x": 100.5, "y": -200.25, "room": -3, "sprite": "spr_player_idle", "frame": 4, "dir": -1,
+    "palette": 2, "paletteSprite": "spr_peppalette", "paletteTexture": "", "color": "red", "ack": 7
+}
+
+CLIENTS = [{
+    "id": i, "x": 100.5 + i, "y": 200.25, "name": f"Player{i}", "admin": False, "room": 3, "sprite": "spr_player_idle",
+    "frame": i % 12, "dir": 1, "palette": 2, "paletteSprite": "spr_peppalette", "paletteTexture": "", "color": "red"
+} for i in range(3)]
+
+MSGS = [{"body": f"message number {i}", "username": "Player", "id": i, "mid": i} for i in range(2)]
+
+def state(sprite: str) -> dict:
+    return {"type": 2, "x": 1.0, "y": 2.0, "room": 3, "sprite": sprite}
+
+class FrameTest(unittest.TestCase):
+    def test_frames_split_and_joined(self):
+        client, server = BinaryCodec(), BinaryCodec()
+        data = client.encode_packet(STATE) + client.encode_packet({"type": 3})
+
+        # One byte at a time, nothing comes out until a frame is whole
+        frames = []
+        for i in range(len(data)):
+            frames += server.feed(data[i:i + 1])
+
+        self.assertEqual([server.decode(frame) for frame in frames], [STATE, {"type": 3}])
+        self.assertEqual(len(server.Buffer), 0)
+
+    def test_oversized_frame(self):
+        server = BinaryCodec(max_frame = 16)
+
+        with self.assertRaises(CodecError):
+            server.feed(BinaryCodec().encode_packet({"type": 4, "msg": "x" * 32}))
+
+    def test_bad_frames(self):
+        server = BinaryCodec()
+
+        with self.assertRaises(CodecError):
+            server.decode(b"")
+
+        with self.assertRaises(CodecError):
+            server.decode(bytes([0x7F]))
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.Client, self.Server = BinaryCodec(), BinaryCodec()
+
+    def packet(self, **fields) -> dict:
+        return self.Server.decode(self.Server.feed(self.Client.encode_packet(fields))[0])
+
+    def response(self, *args) -> dict:
+        return self.Client.decode_response(self.Client.feed(self.Server.encode_default(*args))[0])
+
+    def test_packets(self):
+        self.assertEqual(self.packet(**STATE), STATE)
+        self.assertEqual(self.packet(type = 3), {"type": 3})
+        self.assertEqual(self.packet(type = 4, msg = "hi 漢字"), {"type": 4, "msg": "hi 漢字"})
+
+    def test_interning(self):
+        self.assertEqual(self.packet(**STATE), STATE)
+
+        # The second time every string is an interned index, and a changed one is defined next to the known ones
+        self.assertEqual(self.packet(**STATE), STATE)
+        changed = dict(STATE, sprite = "spr_player_move", dir = -128)
+        self.assertEqual(self.packet(**changed), changed)
+        self.assertEqual(self.Server.Incoming, ["spr_player_idle", "spr_peppalette", "", "red", "spr_player_move"])
+
+    def test_truncation_keeps_whole_characters(self):
+        # Also once the truncated string is interned
+        self.assertEqual(self.packet(type = 2, sprite = "é" * 200)["sprite"], "é" * 127)
+        self.assertEqual(self.packet(type = 2, sprite = "é" * 200)["sprite"], "é" * 127)
+        self.assertEqual(self.packet(type = 4, msg = "ü" * 40000)["msg"], "ü" * 32767)
+
+    def test_responses(self):
+        clients = [dict(c) for c in CLIENTS]
+        clients[1].update(dir = -1, x = -16.5, name = "ñ" * 200, sprite = "spr_knight")
+        msgs = MSGS + [{"body": "server says hi", "username": "[NotPTT]", "id": -1, "mid": 2}]
+
+        for _ in range(2):
+            decoded = self.response(1234, True, True, "Player", 3, clients, msgs)
+
+            self.assertEqual(decoded["msgs"], msgs)
+            self.assertEqual(decoded["clients"][0], clients[0])
+            self.assertEqual(decoded["clients"][1], dict(clients[1], name = "ñ" * 127))
+            self.assertEqual((decoded["id"], decoded["loggedIn"], decoded["admin"], decoded["name"], decoded["onlineCnt"]), (1234, True, True, "Player", 3))
+
+    def test_messages(self):
+        message = self.Client.decode_response(self.Client.feed(self.Server.encode_message(5, "x\ny 漢字"))[0])
+        self.assertEqual(message, {"type": 5, "msg": "x\ny 漢字"})
+
+class ProtocolSwitchTest(unittest.TestCase):
+    def login(self, **extra) -> tuple:
+        srv = make_server()
+        c = make_client(srv)
+        codec = BinaryCodec()
+
+        login = {"type": MessageType.ImsgLogin.value, "name": "bob", "ver": srv.Version, "lobby": "a", "binary": True, **extra}
+        return c, codec, json.dumps(login).encode()
+
+    def responses(self, c, codec: BinaryCodec) -> list[dict]:
+        frames = codec.feed(c.Conn.Sent)
+        c.Conn.Sent = b""
+
+        return [codec.decode_response(frame) for frame in frames]
+
+    def test_binary_after_json_login(self):
+        c, codec, login = self.login()
+
+        c.receive(login + b"\n")
+        self.assertTrue(c.LoggedIn)
+        self.assertIsNotNone(c.Codec)
+
+        # The reply to the login is already framed, starting with the queued announcement
+        self.assertEqual(self.responses(c, codec)[0]["msg"], "bob has entered the tower!")
+
+        for _ in range(2):
+            c.receive(codec.encode_packet(STATE))
+            self.assertEqual((c.Data.X, c.Data.Room, c.Data.Sprite), (100.5, -3, "spr_player_idle"))
+            self.assertTrue(all("type" in r for r in self.responses(c, codec)))
+
+    def test_frames_in_the_login_read(self):
+        c, codec, login = self.login()
+        moved = dict(STATE, room = 10, x = 5.0)
+
+        c.receive(login + codec.encode_packet(STATE) + codec.encode_packet(moved))
+
+        self.assertTrue(c.LoggedIn)
+        self.assertEqual((c.Data.X, c.Data.Room), (5.0, 10))
+
+    def test_json_login_stays_json(self):
+        c, codec, login = self.login(binary = False)
+
+        c.receive(login + b"\n" + json.dumps(STATE).encode() + b"\n")
+
+        self.assertIsNone(c.Codec)
+        self.assertEqual(c.Data.Room, -3)
+        self.assertTrue(c.Conn.Sent.startswith(b"{"))
+
+class InterningLimitTest(unittest.TestCase):
+    def roundtrip(self, sprites: list[str]) -> BinaryCodec:
+        client, server = BinaryCodec(), BinaryCodec()
+
+        for sprite in sprites:
+            packet = server.decode(server.feed(client.encode_packet(state(sprite)))[0])
+            self.assertEqual(packet["sprite"], sprite)
+
+        return server
+
+    def test_many_strings_are_sent_as_literals(self):
+        server = self.roundtrip([f"spr_{i}" for i in range(MAX_STRINGS + 500)])
+
+        self.assertLessEqual(len(server.Incoming), MAX_STRINGS)
+
+    def test_long_strings_stay_within_byte_budget(self):
+        server = self.roundtrip([f"{i:05}" + "x" * 250 for i in range(400)])
+
+        self.assertLessEqual(server.IncomingBytes, MAX_STRING_BYTES)
+        self.assertLess(len(server.Incoming), 400)
+
+    def test_defining_past_the_limit_is_refused(self):
+        attacker, server = BinaryCodec(), BinaryCodec()
+
+        with self.assertRaises(CodecError):
+            for i in range(MAX_STRINGS + 1):
+                # Forgetting what was sent makes the encoder define every string again
+                attacker.Outgoing.clear()
+                attacker.OutgoingBytes = 0
+                server.decode(server.feed(attacker.encode_packet(state(f"spr_{i}")))[0])
+
+        self.assertLessEqual(len(server.Incoming), MAX_STRINGS)
+        self.assertLessEqual(server.IncomingBytes, MAX_STRING_BYTES)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import types
+import unittest
+
+from PTServer.chat import MessageIds
+from PTServer.lobby import Lobby
+
+def member(id: int, room: int):
+    return types.SimpleNamespace(ID = id, Data = types.SimpleNamespace(Room = room))
+
+class LobbyRoomTest(unittest.TestCase):
+    def test_remove_after_move_before_data_update(self):
+        lobby = Lobby("a", MessageIds())
+        c = member(1, 1)
+        lobby.add(c)
+
+        # The client is moved in the index, then closed from another thread before it sets Data.Room
+        lobby.move(c, 2)
+        self.assertTrue(lobby.remove(c))
+
+        self.assertEqual(lobby.Rooms, {})
+        self.assertEqual(lobby.Placed, {})
+
+    def test_move_keeps_other_members(self):
+        lobby = Lobby("a", MessageIds())
+        a, b = member(1, 1), member(2, 1)
+        lobby.add(a)
+        lobby.add(b)
+
+        lobby.move(a, 3)
+
+        self.assertEqual(set(lobby.room(1)), {2})
+        self.assertEqual(set(lobby.room(3)), {1})
+
+        lobby.remove(b)
+        self.assertEqual(set(lobby.Rooms), {3})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import tempfile
+import time
+import types
+import unittest
+
+from PTServer.profiling import ClientProfile, Profiling
+
+class Admin:
+    def __init__(self):
+        self.Active: bool = True
+        self.Messages: list[str] = []
+
+    def server_pm(self, msg: str):
+        self.Messages.append(msg)
+
+class ClientProfileTest(unittest.TestCase):
+    def test_empty_summary(self):
+        self.assertEqual(ClientProfile().summary(), ["No calls recorded, the client sent nothing while it was profiled."])
+
+    def test_idle_client_is_still_reported(self):
+        admin = Admin()
+        target = types.SimpleNamespace(ID = 1, Profile = None)
+
+        with tempfile.TemporaryDirectory() as directory:
+            profiling = Profiling(types.SimpleNamespace(), directory)
+            self.assertTrue(profiling.profile(admin, target, 0.05))
+
+            deadline = time.monotonic() + 5
+            while profiling.Running and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertFalse(profiling.Running)
+        self.assertEqual(len(admin.Messages), 2)
+        self.assertTrue(admin.Messages[0].startswith("Profile written to"))
+        self.assertIn("No calls recorded", admin.Messages[1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from PTServer import shards
+from PTServer.codec import BinaryCodec
+from PTServer.stream import JsonStream
+
+from support import make_client, make_server
+
+LOGIN = b'{"type": 1, "name": "bob", "lobby": "a", "binary": true}'
+
+def state_frame() -> bytes:
+    """ An update whose room is encoded as a 0x0A byte, which a newline split would cut in two. """
+    return BinaryCodec().encode_packet({"type": 2, "x": 1.5, "y": 2.5, "room": 10, "sprite": "spr_player_idle"})
+
+class StreamSwitchTest(unittest.TestCase):
+    def test_login_without_newline_then_frame(self):
+        stream = JsonStream()
+        frame = state_frame()
+
+        packets = stream.feed(LOGIN + frame, lambda packet: packet.get("binary", None) is True)
+
+        self.assertIn(b"\n", frame)
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0]["name"], "bob")
+        self.assertEqual(stream.Buffer, frame)
+
+        codec = BinaryCodec()
+        self.assertEqual(codec.decode(codec.feed(stream.Buffer)[0])["room"], 10)
+
+    def test_login_with_newline_then_frame(self):
+        stream = JsonStream()
+        frame = state_frame()
+
+        packets = stream.feed(b'{"type": 3}\n' + LOGIN + b"\r\n" + frame, lambda packet: packet.get("binary", None) is True)
+
+        self.assertEqual([packet["type"] for packet in packets], [3, 1])
+        self.assertEqual(stream.Buffer, frame)
+
+    def test_login_split_across_reads(self):
+        stream = JsonStream()
+        frame = state_frame()
+        data = LOGIN + frame
+        stop = lambda packet: packet.get("binary", None) is True
+
+        self.assertEqual(stream.feed(data[:20], stop), [])
+        self.assertEqual(len(stream.feed(data[20:], stop)), 1)
+        self.assertEqual(stream.Buffer, frame)
+
+    def test_front_hand_over_stops_at_login(self):
+        stream = JsonStream()
+        frame = state_frame()
+
+        packets = stream.feed(LOGIN + frame, shards.is_login)
+
+        self.assertEqual(packets[0]["lobby"], "a")
+        self.assertEqual(stream.Buffer, frame)
+
+    def test_client_logs_in_and_decodes_frame(self):
+        srv = make_server()
+        c = make_client(srv)
+
+        login = LOGIN[:-1] + f', "ver": "{srv.Version}"}}'.encode()
+        c.receive(login + state_frame())
+
+        self.assertTrue(c.LoggedIn)
+        self.assertIsNotNone(c.Codec)
+        self.assertEqual(c.Data.Room, 10)
+
+if __name__ == "__main__":
+    unittest.main()
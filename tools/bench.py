@@ -0,0 +1,477 @@
+"""
+Microbenchmarks for the server's hot paths.
+
+Usage: python tools/bench.py [name ...] [--save] [--check] [--baseline tools/bench_baseline.json] [--tolerance 0.3]
+
+--save writes the results as the baseline, --check exits non-zero if anything got slower or allocates more than it.
+Baselines depend on the machine, so save one before the change being measured and check after it.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PTServer
+import PTUtils
+
+from PTConfig import Config
+from PTServer.codec import BinaryCodec
+
+BENCHMARKS = {}
+RESULTS: dict[str, dict[str, float]] = {}
+CURRENT = [""]
+
+# Client counts the hot paths are measured at
+SCALES = (10, 128, 1000)
+
+def benchmark(name: str):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+
+    return register
+
+def measure(fn, seconds: float = 1.0) -> float:
+    """ Calls fn repeatedly for roughly the given time and returns calls per second. """
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+
+    while True:
+        for _ in range(batch):
+            fn()
+
+        calls += batch
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= seconds:
+            return calls / elapsed
+
+        batch *= 2
+
+def report(name: str, ops: float, extra: str = "", **fields: float):
+    RESULTS[f"{CURRENT[0]}/{name}"] = {"ops": ops, **fields}
+    output(f"  {name:<32} {ops:>12,.0f} ops/s {extra}")
+
+def allocations(fn, calls: int = 200) -> tuple[int, float]:
+    """ Returns the peak bytes allocated during one call, and the memory blocks per call still held after many. """
+    fn()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    blocks = sys.getallocatedblocks()
+    for _ in range(calls):
+        fn()
+
+    return peak, (sys.getallocatedblocks() - blocks) / calls
+
+def profile(name: str, fn, seconds: float = 0.5):
+    """ Reports calls per second and allocations of fn. """
+    ops = measure(fn, seconds)
+    peak, kept = allocations(fn)
+
+    report(name, ops, f"{peak:>9,} B peak {kept:>6.1f} blocks kept", peak = peak, kept = kept)
+
+def output(line: str):
+    # The server prints on connects and disconnects, benchmarks run with stdout swallowed
+    print(line, file=sys.__stdout__)
+
+class FakeConn:
+    """ Stands in for a client socket, counting what the server sends. """
+    def __init__(self):
+        self.Sent: int = 0
+
+    def send(self, data: bytes):
+        self.Sent += len(data)
+
+    def flush(self) -> int:
+        return 0
+
+    def pending(self) -> int:
+        return 0
+
+    def recv(self, size: int) -> bytes:
+        return b""
+
+    def close(self):
+        pass
+
+class TimedLock:
+    """ Lock wrapper that adds up how long callers waited to acquire it, per thread name. """
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Waited: dict[str, float] = {}
+
+    def acquire(self, *args) -> bool:
+        start = time.perf_counter()
+        acquired = self.Lock.acquire(*args)
+
+        name = threading.current_thread().name
+        self.Waited[name] = self.Waited.get(name, 0) + time.perf_counter() - start
+
+        return acquired
+
+    def release(self):
+        self.Lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def waited(self, prefix: str) -> float:
+        return sum(waited for name, waited in self.Waited.items() if name.startswith(prefix))
+
+def make_server(**overrides) -> PTServer.Server:
+    fields = {
+        "Host": "127.0.0.1",
+        "Port": 0,
+        "Timeout": 10,
+        "MaxPlayers": 100000,
+        "MaxConnections": 100000,
+        "Anticheat": True,
+        "Keys": [],
+        "Bans": [],
+        "BadWords": ["fart"]
+    }
+    fields.update(overrides)
+    config = Config(**fields)
+
+    return PTServer.Server(config = config)
+
+def make_client(server: PTServer.Server, id: int, lobby: str = "lobby", room: int = 0) -> PTServer.Client:
+    """ Registers a logged in client without a real connection. """
+    c = PTServer.Client(id = id, conn = FakeConn(), ip256 = f"ip{id}", server = server)
+
+    c.admit()
+
+    c.Name = f"Player{id}"
+    c.Data.Room = room
+    c.Data.X = id % 500
+    c.Data.Sprite = "spr_player_idle"
+    server.join_lobby(c, lobby)
+    c.LoggedIn = True
+
+    return c
+
+def sample_clients(count: int) -> list[dict]:
+    return [{
+        "id": i,
+        "x": 100.5 + i,
+        "y": 200.25,
+        "name": f"Player{i}",
+        "admin": False,
+        "room": 3,
+        "sprite": "spr_player_idle",
+        "frame": i % 12,
+        "dir": 1,
+        "palette": 2,
+        "paletteSprite": "spr_peppalette",
+        "paletteTexture": "",
+        "color": "red"
+    } for i in range(count)]
+
+def sample_msgs(count: int) -> list[dict]:
+    return [{"body": f"message number {i}", "username": "Player", "id": i, "mid": i} for i in range(count)]
+
+@benchmark("codec")
+def codec():
+    """ Binary codec against the JSON protocol for inputs and a 32 player response. """
+    packet = {
+        "type": 2, "x": 100.5, "y": 200.25, "room": 3, "sprite": "spr_player_idle", "frame": 4, "dir": 1,
+        "palette": 2, "paletteSprite": "spr_peppalette", "paletteTexture": "", "color": "red"
+    }
+
+    # Warm both interning tables so the steady state is measured
+    client, server = BinaryCodec(), BinaryCodec()
+    server.decode(server.feed(client.encode_packet(packet))[0])
+
+    json_packet = json.dumps(packet).encode()
+    binary_packet = client.encode_packet(packet)
+
+    report("decode input json", measure(lambda: json.loads(json_packet)), f"{len(json_packet)} B")
+    report("decode input binary", measure(lambda: server.decode(server.feed(binary_packet)[0])), f"{len(binary_packet)} B")
+
+    clients, msgs = sample_clients(32), sample_msgs(16)
+    response = {"clients": clients, "msgs": msgs, "type": 5, "loggedIn": True, "admin": False, "name": "Player", "id": 1, "onlineCnt": 33}
+
+    server.encode_default(1, True, False, "Player", 33, clients, msgs)
+    json_response = json.dumps(response).encode()
+    binary_response = server.encode_default(1, True, False, "Player", 33, clients, msgs)
+
+    report("encode response json", measure(lambda: json.dumps(response).encode()), f"{len(json_response)} B")
+    report("encode response binary", measure(lambda: server.encode_default(1, True, False, "Player", 33, clients, msgs)), f"{len(binary_response)} B")
+
+@benchmark("registry")
+def registry():
+    """ Readers of the client registry while other threads log in, log out and change rooms. """
+    server = make_server()
+    lock = TimedLock()
+    server.ClientMutex = lock
+
+    for id in range(1000):
+        make_client(server, id, f"lobby{id % 8}", id % 4)
+
+    running = True
+    reads = [0]
+    builds = [0]
+
+    def reader():
+        while running:
+            server.lobby_members("lobby0")
+            server.lobby_count("lobby1")
+            server.room_members("lobby2", 1)
+            reads[0] += 1
+
+    def builder():
+        while running:
+            server.World.build()
+            builds[0] += 1
+
+    def churn(start: int):
+        id = start
+        while running:
+            c = make_client(server, id, f"lobby{id % 8}")
+            server.move_room(c, 1)
+            c.Data.Room = 1
+            c.close(PTServer.MessageType.MsgNone, "")
+            id += 1
+
+    threads = [threading.Thread(target=reader, name=f"reader{i}") for i in range(4)]
+    threads += [threading.Thread(target=builder, name="builder")]
+    threads += [threading.Thread(target=churn, args=(100000 * (i + 1),), name=f"writer{i}") for i in range(2)]
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(2)
+    running = False
+
+    for thread in threads:
+        thread.join()
+
+    report("registry reads", reads[0] / 2)
+    report("world builds", builds[0] / 2)
+    output(f"  {'ClientMutex wait (readers)':<32} {lock.waited('reader') * 1000:>12,.1f} ms")
+    output(f"  {'ClientMutex wait (builder)':<32} {lock.waited('builder') * 1000:>12,.1f} ms")
+    output(f"  {'ClientMutex wait (writers)':<32} {lock.waited('writer') * 1000:>12,.1f} ms")
+
+def legacy_clean(msg: str, length: int, bad_words: list[str]) -> str:
+    """ PTUtils.clean before the filter was compiled, kept to compare against. """
+    msg = msg.strip()
+    msg = ''.join(c for c in msg if c in PTUtils.VALID_NAME_CHARS)
+
+    if len(msg) > length and length > 0:
+        msg = msg[:length]
+
+    for word in bad_words:
+        msg = msg.replace(word, "*"*len(word))
+
+    return msg
+
+@benchmark("clean")
+def clean():
+    """ PTUtils.clean on a full length chat line, per character loop against the compiled filter. """
+    words = ["fart"] + [f"badword{i}" for i in range(199)]
+    msg = ("hello there fart, how is it going? " * 8)[:256]
+    compiled = PTUtils.WordFilter(words)
+
+    assert legacy_clean(msg, 256, words) == PTUtils.clean(msg, 256, compiled)
+
+    report("clean legacy (1 word)", measure(lambda: legacy_clean(msg, 256, words[:1])))
+    single = PTUtils.WordFilter(words[:1])
+    report("clean compiled (1 word)", measure(lambda: PTUtils.clean(msg, 256, single)))
+    report("clean legacy (200 words)", measure(lambda: legacy_clean(msg, 256, words)))
+    report("clean compiled (200 words)", measure(lambda: PTUtils.clean(msg, 256, compiled)))
+
+    leet = PTUtils.WordFilter(words, ignore_case=True, leetspeak=True)
+    report("clean compiled, any case + leet", measure(lambda: PTUtils.clean(msg, 256, leet)))
+
+def legacy_anticheat(sprite: str) -> str:
+    if not sprite.startswith("spr_player") and not sprite.startswith("spr_knight") and not sprite.startswith("spr_shotgun") and not sprite.startswith("spr_ratmount") and not sprite.startswith("spr_lone") and sprite != "spr_noise_vulnerable2" and sprite != "spr_noise_crusherfall":
+        sprite = "spr_player_idle"
+
+    return sprite
+
+@benchmark("anticheat")
+def anticheat():
+    """ Sprite validation and movement checks for one ClientData packet. """
+    server = make_server(AnticheatMaxJump=64, AnticheatRoomChanges=10)
+    c = make_client(server, 1)
+    cheats = server.Cheats
+
+    for sprite in ("spr_player_idle", "spr_lonegustavo_walk", "spr_noise_crusherfall", "spr_hack"):
+        assert legacy_anticheat(sprite) == cheats.check_sprite(sprite)
+
+    report("sprite legacy (allowed)", measure(lambda: legacy_anticheat("spr_lonegustavo_walk")))
+    report("sprite table (allowed)", measure(lambda: cheats.check_sprite("spr_lonegustavo_walk")))
+    report("sprite legacy (rejected)", measure(lambda: legacy_anticheat("spr_hack")))
+    report("sprite table (rejected)", measure(lambda: cheats.check_sprite("spr_hack")))
+    report("movement", measure(lambda: cheats.check_movement(c, c.Data.X + 4, c.Data.Y, c.Data.Room)))
+
+def legacy_from_dict(data: dict) -> PTServer.client.ClientData:
+    template = PTServer.client.ClientData()
+
+    for key, value in data.items():
+        trueKey = key[0].upper() + key[1:]
+        setattr(template, trueKey, value)
+
+    return template
+
+@benchmark("decode")
+def decode():
+    """ Turning one received ImsgDefault packet into client state. """
+    packet = {
+        "type": 2, "x": 100.5, "y": 200.25, "room": 3, "sprite": "spr_player_idle", "frame": 4, "dir": 1,
+        "palette": 2, "paletteSprite": "spr_peppalette", "paletteTexture": "", "color": "red"
+    }
+    raw = json.dumps(packet).encode() + b"\n"
+    state = PTServer.client.ClientData()
+
+    report("from_dict setattr per key", measure(lambda: legacy_from_dict(packet)))
+    report("from_dict field map", measure(lambda: PTServer.client.ClientData.from_dict(packet)))
+    report("from_dict + update in place", measure(lambda: state.update(PTServer.client.ClientData.from_dict(packet))))
+
+    server = make_server()
+    c = make_client(server, 1, room = 3)
+    report("Client.parse (json)", measure(lambda: c.parse(raw)))
+
+@benchmark("world")
+def world():
+    """ Rebuilding a 128 player room snapshot and one client's response from it. """
+    server = make_server()
+    clients = [make_client(server, id, room = 1) for id in range(1, 129)]
+    viewer = clients[0]
+
+    def rebuild(dirty: int):
+        for c in clients[:dirty]:
+            c.Dirty = True
+
+        server.World.build_room("lobby", 1)
+
+    report("build room (all changed)", measure(lambda: rebuild(128)))
+    report("build room (16 changed)", measure(lambda: rebuild(16)))
+    report("build room (none changed)", measure(lambda: rebuild(0)))
+    report("visible() response fragment", measure(lambda: server.World.visible(viewer)))
+
+@benchmark("hot")
+def hot():
+    """ Per-packet and per-response functions with 10, 128 and 1000 clients in one room. """
+    packet = {
+        "type": 2, "x": 100.5, "y": 200.25, "room": 1, "sprite": "spr_player_idle", "frame": 4, "dir": 1,
+        "palette": 2, "paletteSprite": "spr_peppalette", "paletteTexture": "", "color": "red"
+    }
+    raw = json.dumps(packet).encode() + b"\n"
+    msg = ("hello there fart, how is it going? " * 8)[:256]
+
+    for count in SCALES:
+        server = make_server()
+        clients = [make_client(server, id, room = 1) for id in range(1, count + 1)]
+        first, last = clients[0], clients[-1]
+        message = PTServer.Message(Body = "hi", Username = "Player1", Id = 1)
+
+        cases = {
+            "Client.parse": lambda: first.parse(raw),
+            "ClientData.from_dict": lambda: PTServer.client.ClientData.from_dict(packet),
+            "response assembly": first.encode_default,
+            "PTUtils.clean": lambda: PTUtils.clean(msg, 256, server.Filter),
+            "PTUtils.clean_name": lambda: PTUtils.clean_name("Fart Player", server.Filter),
+            "PTUtils.anticheat": lambda: PTUtils.anticheat("spr_lonegustavo_walk"),
+            "Anticheat.check_sprite": lambda: server.Cheats.check_sprite("spr_lonegustavo_walk"),
+            "Server.lobby_count": lambda: server.lobby_count("lobby"),
+            "Client.pm": lambda: last.pm(message)
+        }
+
+        for name, fn in cases.items():
+            profile(f"{name} ({count})", fn)
+
+def compare(baseline: dict[str, dict[str, float]], tolerance: float) -> list[str]:
+    """ Returns a line for every result that's worse than its baseline by more than the tolerance. """
+    failures = []
+
+    for key, result in RESULTS.items():
+        base = baseline.get(key, None)
+        if base is None:
+            continue
+
+        if result["ops"] < base["ops"] * (1 - tolerance):
+            failures.append(f"{key}: {result['ops']:,.0f} ops/s, baseline {base['ops']:,.0f}")
+
+        # A few bytes either way are noise, only growth past the tolerance counts
+        if "peak" in base and result.get("peak", 0) > base["peak"] * (1 + tolerance) + 256:
+            failures.append(f"{key}: {result['peak']:,} B peak, baseline {base['peak']:,}")
+
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description = "Microbenchmarks for the server's hot paths.")
+    parser.add_argument("names", nargs = "*", help = f"benchmarks to run, out of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--baseline", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json"))
+    parser.add_argument("--save", action = "store_true", help = "save the results as the baseline")
+    parser.add_argument("--check", action = "store_true", help = "fail if anything regressed against the baseline")
+    parser.add_argument("--tolerance", type = float, default = 0.3, help = "how much slower or bigger counts as a regression")
+    args = parser.parse_args()
+
+    for name in args.names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}")
+            continue
+
+        output(f"{name}: {BENCHMARKS[name].__doc__.strip()}")
+        CURRENT[0] = name
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            BENCHMARKS[name]()
+
+    if args.check:
+        try:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        except Exception as e:
+            print(f"Failed to load baseline from {args.baseline}: {e}")
+            sys.exit(2)
+
+        failures = compare(baseline, args.tolerance)
+
+        if len(failures) > 0:
+            print(f"{len(failures)} regression(s) against {args.baseline}:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+
+        print(f"No regressions against {args.baseline}")
+
+    if args.save:
+        # Keep results of benchmarks that weren't run this time
+        try:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        except Exception:
+            baseline = {}
+
+        baseline.update(RESULTS)
+
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent = 4)
+
+        print(f"Saved {len(RESULTS)} results to {args.baseline}")
+
+if __name__ == "__main__":
+    main()
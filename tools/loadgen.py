@@ -0,0 +1,460 @@
+"""
+Bot swarm load generator, runs a local server in its own process and connects simulated players to it.
+
+Usage: python tools/loadgen.py [--clients 64] [--lobbies 4] [--rate 30] [--duration 10] [--output results.json]
+       python tools/loadgen.py --connect host:port ...   (against a server that's already running, no CPU or tick numbers)
+
+With --tick-rate the results include the server's tick durations, read from its metrics endpoint on --port + 1.
+Percentiles of those are histogram bucket bounds, which double, so mean_ms is the finer number.
+
+Engine comparison, with bots and server sharing one single-core VM:
+    python tools/loadgen.py --engine threaded --clients 2000 --lobbies 100 --rooms 5 --rate 5 --chat-every 0 --tick-rate 20 --duration 15 --ramp 5 --timeout 5
+    python tools/loadgen.py --engine asyncio --clients 2000 --lobbies 100 --rooms 5 --rate 5 --chat-every 0 --tick-rate 20 --duration 15 --ramp 5 --timeout 5
+
+    clients  engine    connected  response p99 ms  tick mean / p99 ms  overruns  server CPU
+    1000     threaded  1000       432              36.5 / 131          68        42.5%
+    1000     asyncio   1000       304              39.9 / 131          90        44.6%
+    2000     threaded  2000       647              36.5 / 131          107       42.7%
+    2000     asyncio   2000       383              34.5 / 131          104       42.1%
+    3000     threaded  3000       445              35.2 / 131          98        43.2%
+    3000     asyncio   3000       437              36.2 / 131          147       42.4%
+
+Both engines held every client without failures, and their tick times were in the same bucket.
+The bots used the rest of the core, so the server never got more than about 43% of it, which doesn't separate the engines.
+Run the server on its own machine for that, with --connect, and read its tick times from /stats.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PTServer
+import PTUtils
+
+from PTConfig import Config
+from PTServer.codec import BinaryCodec, CodecError
+from PTServer.messages import MessageType
+
+SPRITES = ("spr_player_idle", "spr_player_move", "spr_player_jump", "spr_knight_idle")
+CHAT = ("hello", "anyone here?", "this level is hard", "gg", "where is the secret")
+
+class Stats:
+    """ Counters shared by every bot. """
+    def __init__(self):
+        self.Connect: list[float] = []
+        self.Latency: list[float] = []
+        self.Responses: int = 0
+        self.BytesIn: int = 0
+        self.BytesOut: int = 0
+        self.ParseFails: int = 0
+        self.Timeouts: int = 0
+        self.Kicked: int = 0
+        self.Deltas: int = 0
+        self.Failed: int = 0
+
+class Bot:
+    """ One simulated player, speaking JSON or the binary protocol. """
+    def __init__(self, index: int, args: argparse.Namespace, stats: Stats):
+        self.Index: int = index
+        self.Args: argparse.Namespace = args
+        self.Stats: Stats = stats
+        self.Name: str = f"bot{index}"
+        self.Lobby: str = f"lobby{index % args.lobbies}"
+        self.Codec: BinaryCodec | None = BinaryCodec() if args.binary else None
+        self.Framed: bool = False
+        self.Buffer: bytes = b""
+        self.Decoder = json.JSONDecoder()
+        # Last delta sequence number received, echoed back so the server can diff against it
+        self.Ack: int = 0
+
+        self.Reader: asyncio.StreamReader | None = None
+        self.Writer: asyncio.StreamWriter | None = None
+        self.Closed: bool = False
+
+    async def run(self, host: str, port: int, version: str, deadline: float):
+        start = time.perf_counter()
+
+        try:
+            self.Reader, self.Writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.Stats.Failed += 1
+            return
+
+        # Logins are always JSON, the binary protocol starts with the first response
+        login = {"type": MessageType.ImsgLogin.value, "name": self.Name, "ver": version, "lobby": self.Lobby, "color": "red"}
+        if self.Args.binary:
+            login["binary"] = True
+        elif self.Args.delta:
+            login["delta"] = True
+
+        # Responses are read with raw_decode, so JSON bots can take queued messages in batches
+        if not self.Args.binary:
+            login["batch"] = True
+
+        self.write(json.dumps(login).encode() + b"\n")
+
+        if await self.response() is None:
+            self.Stats.Failed += 1
+            self.close()
+            return
+
+        self.Stats.Connect.append(time.perf_counter() - start)
+
+        interval = 1 / self.Args.rate
+        next_chat = time.perf_counter() + random.uniform(0, self.Args.chat_every) if self.Args.chat_every > 0 else None
+        x, y, seq = random.uniform(0, 1000), random.uniform(0, 500), 0
+
+        while not self.Closed and time.perf_counter() < deadline:
+            tick = time.perf_counter()
+            seq += 1
+            x += random.uniform(-4, 4)
+
+            packet = {
+                "type": MessageType.ImsgDefault.value,
+                "x": x,
+                "y": y,
+                "room": self.Index % self.Args.rooms,
+                "sprite": SPRITES[seq // 30 % len(SPRITES)],
+                "frame": seq % 12,
+                "dir": 1,
+                "palette": 0,
+                "paletteSprite": "spr_peppalette",
+                "paletteTexture": "",
+                "color": "red"
+            }
+
+            if self.Ack > 0:
+                packet["ack"] = self.Ack
+
+            self.send(packet)
+
+            sent = time.perf_counter()
+            if await self.response() is not None:
+                self.Stats.Latency.append(time.perf_counter() - sent)
+
+            if next_chat is not None and tick >= next_chat:
+                next_chat = tick + self.Args.chat_every
+                self.chat()
+                await self.response()
+
+            await asyncio.sleep(max(0, interval - (time.perf_counter() - tick)))
+
+        self.close()
+
+    def chat(self):
+        roll = random.random()
+
+        if roll < 0.1:
+            msg = "/who"
+        elif roll < 0.3:
+            msg = f"/pm bot{random.randrange(self.Args.clients)} {random.choice(CHAT)}"
+        else:
+            msg = random.choice(CHAT)
+
+        self.send({"type": MessageType.ImsgMessage.value, "msg": msg})
+
+    def send(self, packet: dict):
+        if self.Codec is not None:
+            self.write(self.Codec.encode_packet(packet))
+        else:
+            self.write(json.dumps(packet).encode() + b"\n")
+
+    def write(self, data: bytes):
+        if self.Closed:
+            return
+
+        self.Stats.BytesOut += len(data)
+        self.Writer.write(data)
+
+    async def response(self) -> dict | None:
+        """ Reads until at least one whole response arrived, returns the last one or None on timeout or disconnect. """
+        try:
+            while True:
+                responses = self.decode()
+
+                if len(responses) > 0:
+                    self.Stats.Responses += len(responses)
+
+                    for response in responses:
+                        if response.get("type", None) == MessageType.OmsgKick.value:
+                            self.Stats.Kicked += 1
+                            self.close()
+
+                        if "seq" in response:
+                            self.Ack = response["seq"]
+
+                            if response.get("base", 0) > 0:
+                                self.Stats.Deltas += 1
+
+                    return responses[-1]
+
+                data = await asyncio.wait_for(self.Reader.read(65536), self.Args.timeout)
+                if not data:
+                    self.close()
+                    return None
+
+                self.Stats.BytesIn += len(data)
+                self.Buffer += data
+        except asyncio.TimeoutError:
+            self.Stats.Timeouts += 1
+        except (OSError, CodecError, ValueError):
+            self.Stats.ParseFails += 1
+            self.Buffer = b""
+
+        return None
+
+    def decode(self) -> list[dict]:
+        # A refused login is answered in JSON, binary frames never start with "{" as that would be a 2 GB frame
+        if self.Codec is not None and (self.Framed or self.Buffer[:1] not in (b"", b"{")):
+            self.Framed = True
+            data, self.Buffer = self.Buffer, b""
+            return [self.Codec.decode_response(frame) for frame in self.Codec.feed(data)]
+
+        text = self.Buffer.decode(errors="replace")
+        responses = []
+        offset = 0
+
+        while True:
+            while offset < len(text) and text[offset] in " \r\n":
+                offset += 1
+
+            if offset >= len(text):
+                break
+
+            try:
+                response, offset = self.Decoder.raw_decode(text, offset)
+            except ValueError:
+                # Part of a response is still on its way, a broken one is only noticed once there is too much of it
+                if len(text) - offset > 1 << 20:
+                    raise
+                break
+
+            responses.append(response)
+
+        self.Buffer = text[offset:].encode()
+        return responses
+
+    def close(self):
+        if self.Closed:
+            return
+
+        self.Closed = True
+        if self.Writer is not None:
+            self.Writer.close()
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """ Returns the usual percentiles in milliseconds. """
+    if len(samples) == 0:
+        return {}
+
+    ordered = sorted(samples)
+
+    def at(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+
+    return {"p50": at(50), "p90": at(90), "p99": at(99), "max": round(ordered[-1] * 1000, 3)}
+
+def cpu_seconds(pid: int) -> float | None:
+    """ Returns the CPU time used by a process and its children (shards included), None where /proc isn't available. """
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    total = 0
+
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return None
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name can contain spaces, the fields after it can't
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+
+        if int(entry) == pid or int(fields[1]) == pid:
+            total += int(fields[11]) + int(fields[12])
+
+    return total / ticks
+
+def tick_stats(host: str, port: int) -> dict[str, float] | None:
+    """ Reads the tick durations from the server's Prometheus endpoint, None if it can't be reached or has no ticks. """
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics", timeout = 5) as response:
+            text = response.read().decode()
+    except OSError:
+        return None
+
+    buckets = []
+    values = {}
+
+    for line in text.splitlines():
+        if line.startswith('ptt_tick_seconds_bucket{le="'):
+            bound, seen = line[len('ptt_tick_seconds_bucket{le="'):].split('"} ')
+            buckets.append((float(bound), int(seen)))
+        elif line.startswith(("ptt_tick_seconds_sum ", "ptt_tick_seconds_count ", "ptt_tick_overruns_total ")):
+            name, value = line.split()
+            values[name] = float(value)
+
+    count = values.get("ptt_tick_seconds_count", 0)
+    if count == 0:
+        return None
+
+    # Histogram percentiles are bucket upper bounds, the buckets double from 1µs
+    def at(p: float) -> float:
+        return next(round(bound * 1000, 3) for bound, seen in buckets if seen >= count * p / 100)
+
+    return {
+        "ticks": int(count),
+        "mean_ms": round(values["ptt_tick_seconds_sum"] / count * 1000, 3),
+        "p50_ms": at(50),
+        "p99_ms": at(99),
+        "overruns": int(values.get("ptt_tick_overruns_total", 0))
+    }
+
+def serve(options: str):
+    """ Runs the server for a load test, options is the JSON encoded Config fields. """
+    fields = json.loads(options)
+    server = PTServer.Server(config = Config(**fields))
+
+    # An admin is needed so start doesn't stop to ask for one
+    admins = tempfile.NamedTemporaryFile("w", suffix = ".json", delete = False)
+    json.dump([{"username": "loadgen", "password": PTUtils.sha256(PTUtils.keygen_alphanumeric(16))}], admins)
+    admins.close()
+
+    server.AdminPath = admins.name
+    sys.stdout = open(os.devnull, "w")
+
+    try:
+        server.start()
+    finally:
+        os.unlink(admins.name)
+
+def wait_for(host: str, port: int, seconds: float):
+    deadline = time.time() + seconds
+
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout = 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError(f"Server on {host}:{port} didn't come up")
+
+async def swarm(args: argparse.Namespace, host: str, port: int, stats: Stats):
+    deadline = time.perf_counter() + args.ramp + args.duration
+    bots = [Bot(i, args, stats) for i in range(args.clients)]
+    tasks = []
+
+    # Spread the logins over the ramp, a real crowd doesn't connect within the same millisecond
+    for bot in bots:
+        tasks.append(asyncio.create_task(bot.run(host, port, PTServer.VERSION, deadline)))
+        await asyncio.sleep(args.ramp / max(1, args.clients))
+
+    await asyncio.gather(*tasks)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Connects simulated players to a server and reports how it held up.")
+    parser.add_argument("--clients", type = int, default = 64)
+    parser.add_argument("--lobbies", type = int, default = 4)
+    parser.add_argument("--rooms", type = int, default = 2, help = "rooms per lobby the bots are spread over")
+    parser.add_argument("--rate", type = float, default = 30, help = "ImsgDefault packets per second per bot")
+    parser.add_argument("--chat-every", type = float, default = 5, help = "seconds between chat lines, /who and /pm per bot, 0 for none")
+    parser.add_argument("--duration", type = float, default = 10)
+    parser.add_argument("--ramp", type = float, default = 1, help = "seconds over which the bots connect")
+    parser.add_argument("--timeout", type = float, default = 2, help = "seconds to wait for a response")
+    parser.add_argument("--binary", action = "store_true")
+    parser.add_argument("--delta", action = "store_true")
+    parser.add_argument("--engine", default = "threaded")
+    parser.add_argument("--shards", type = int, default = 0)
+    parser.add_argument("--tick-rate", type = int, default = 0)
+    parser.add_argument("--port", type = int, default = 27100)
+    parser.add_argument("--connect", help = "host:port of a running server instead of starting one")
+    parser.add_argument("--output", help = "file to write the JSON results to, printed otherwise")
+    parser.add_argument("--serve", help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve)
+        return
+
+    process = None
+
+    if args.connect is not None:
+        host, port = args.connect.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", args.port
+        fields = {
+            "Host": host, "Port": port, "Timeout": 10, "MaxPlayers": args.clients, "MaxConnections": args.clients,
+            "Anticheat": True, "Keys": [], "Bans": [], "BadWords": ["fart"],
+            "Engine": args.engine, "Shards": args.shards, "TickRate": args.tick_rate,
+            # Tick durations are read from the metrics endpoint at the end
+            "MetricsPort": args.port + 1 if args.tick_rate > 0 else 0
+        }
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", json.dumps(fields)])
+        wait_for(host, port, 10)
+
+    stats = Stats()
+    cpu_before = cpu_seconds(process.pid) if process is not None else None
+    started = time.perf_counter()
+
+    try:
+        asyncio.run(swarm(args, host, port, stats))
+    finally:
+        elapsed = time.perf_counter() - started
+        cpu_after = cpu_seconds(process.pid) if process is not None else None
+        ticks = tick_stats(host, port + 1) if process is not None and args.tick_rate > 0 else None
+
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    results = {
+        "version": PTServer.VERSION,
+        "options": {key: value for key, value in vars(args).items() if key not in ("serve", "output")},
+        "elapsed": round(elapsed, 3),
+        "connected": len(stats.Connect),
+        "failed": stats.Failed,
+        "connect_ms": percentiles(stats.Connect),
+        "latency_ms": percentiles(stats.Latency),
+        "responses": stats.Responses,
+        "responses_per_second": round(stats.Responses / elapsed, 1),
+        "bytes_in": stats.BytesIn,
+        "bytes_out": stats.BytesOut,
+        "parse_failures": stats.ParseFails,
+        "timeouts": stats.Timeouts,
+        "kicked": stats.Kicked,
+        "delta_responses": stats.Deltas,
+        "tick": ticks,
+        "server_cpu_seconds": round(cpu, 3) if cpu is not None else None,
+        "server_cpu_percent": round(cpu / elapsed * 100, 1) if cpu is not None else None
+    }
+
+    text = json.dumps(results, indent = 4)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+    print(text)
+
+if __name__ == "__main__":
+    main()